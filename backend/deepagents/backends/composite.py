@@ -102,6 +102,38 @@ class CompositeBackend:
         backend, stripped_key = self._get_backend_and_key(file_path)
         return backend.read(stripped_key, offset=offset, limit=limit)
 
+    def read_many(
+        self,
+        file_paths: list[str],
+        offset: int = 0,
+        limit: int = 2000,
+    ) -> dict[str, str]:
+        """Read several files, batching the paths that route to the same backend.
+
+        Args:
+            file_paths: Absolute file paths
+            offset: Line offset to start reading from (0-indexed)
+            limit: Maximum number of lines to read
+
+        Returns:
+            Mapping of each original path to its formatted content or error message.
+        """
+        grouped: dict[int, tuple[BackendProtocol, list[tuple[str, str]]]] = {}
+        for file_path in file_paths:
+            backend, stripped_key = self._get_backend_and_key(file_path)
+            grouped.setdefault(id(backend), (backend, []))[1].append((file_path, stripped_key))
+
+        results: dict[str, str] = {}
+        for backend, keys in grouped.values():
+            if hasattr(backend, "read_many"):
+                contents = backend.read_many([stripped for _, stripped in keys], offset=offset, limit=limit)
+                for file_path, stripped_key in keys:
+                    results[file_path] = contents[stripped_key]
+            else:
+                for file_path, stripped_key in keys:
+                    results[file_path] = backend.read(stripped_key, offset=offset, limit=limit)
+        return results
+
     def grep_raw(
         self,
         pattern: str,
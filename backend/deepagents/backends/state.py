@@ -6,6 +6,7 @@ from .protocol import BackendProtocol, EditResult, FileInfo, GrepMatch, WriteRes
 from .utils import (
     _glob_search_files,
     create_file_data,
+    file_data_size,
     file_data_to_string,
     format_read_response,
     grep_matches_from_files,
@@ -66,7 +67,7 @@ class StateBackend(BackendProtocol):
                 continue
 
             # This is a file directly in the current directory
-            size = len("\n".join(fd.get("content", [])))
+            size = file_data_size(fd)
             infos.append(
                 {
                     "path": k,
@@ -114,6 +115,32 @@ class StateBackend(BackendProtocol):
 
         return format_read_response(file_data, offset, limit)
 
+    def read_many(
+        self,
+        file_paths: list[str],
+        offset: int = 0,
+        limit: int = 2000,
+    ) -> dict[str, str]:
+        """Read several files with a single state lookup.
+
+        Args:
+            file_paths: Absolute file paths
+            offset: Line offset to start reading from (0-indexed)
+            limit: Maximum number of lines to read
+
+        Returns:
+            Mapping of each path to its formatted content or error message.
+        """
+        files = self.runtime.state.get("files", {})
+        results: dict[str, str] = {}
+        for file_path in file_paths:
+            file_data = files.get(file_path)
+            if file_data is None:
+                results[file_path] = f"Error: File '{file_path}' not found"
+            else:
+                results[file_path] = format_read_response(file_data, offset, limit)
+        return results
+
     def write(
         self,
         file_path: str,
@@ -176,7 +203,7 @@ class StateBackend(BackendProtocol):
         infos: list[FileInfo] = []
         for p in paths:
             fd = files.get(p)
-            size = len("\n".join(fd.get("content", []))) if fd else 0
+            size = file_data_size(fd) if fd else 0
             infos.append(
                 {
                     "path": p,
@@ -9,6 +9,7 @@ from .protocol import BackendProtocol, EditResult, FileInfo, GrepMatch, WriteRes
 from .utils import (
     _glob_search_files,
     create_file_data,
+    file_data_size,
     file_data_to_string,
     format_read_response,
     grep_matches_from_files,
@@ -216,7 +217,7 @@ class StoreBackend(BackendProtocol):
                 fd = self._convert_store_item_to_file_data(item)
             except ValueError:
                 continue
-            size = len("\n".join(fd.get("content", [])))
+            size = file_data_size(fd)
             infos.append(
                 {
                     "path": item.key,
@@ -366,7 +367,7 @@ class StoreBackend(BackendProtocol):
         infos: list[FileInfo] = []
         for p in paths:
             fd = files.get(p)
-            size = len("\n".join(fd.get("content", []))) if fd else 0
+            size = file_data_size(fd) if fd else 0
             infos.append(
                 {
                     "path": p,
@@ -107,6 +107,19 @@ def file_data_to_string(file_data: dict[str, Any]) -> str:
     return "\n".join(file_data["content"])
 
 
+def file_data_size(file_data: dict[str, Any]) -> int:
+    """Return the length of a FileData's content without joining its lines.
+
+    Args:
+        file_data: FileData dict with 'content' key
+
+    Returns:
+        Length of the content as joined by file_data_to_string
+    """
+    lines = file_data.get("content", [])
+    return sum(map(len, lines)) + max(len(lines) - 1, 0)
+
+
 def create_file_data(content: str, created_at: str | None = None) -> dict[str, Any]:
     """Create a FileData object with timestamps.
 
@@ -0,0 +1,30 @@
+"""Helpers shared by the DeepAgent middleware."""
+
+_COMBINED_PROMPT_CACHE_SIZE = 32
+
+
+def append_system_prompt(cache: dict[str, str], base: str | None, addition: str) -> str:
+    """Return `base` with a middleware's system prompt appended.
+
+    The base prompt is usually identical across the model calls of a thread, so
+    combined prompts are cached per base prompt (bounded, oldest evicted first).
+
+    Args:
+        cache: The calling middleware's cache of combined prompts, keyed by base prompt.
+        base: The system prompt already present on the request, if any.
+        addition: The middleware's own system prompt.
+
+    Returns:
+        The combined system prompt.
+    """
+    if not base:
+        return addition
+    combined = cache.get(base)
+    if combined is None:
+        combined = base + "\n\n" + addition
+        if len(cache) >= _COMBINED_PROMPT_CACHE_SIZE:
+            # The middleware (and its cache) is shared by concurrent model calls, so another
+            # caller may have evicted the same entry or emptied the cache already
+            cache.pop(next(iter(cache), None), None)
+        cache[base] = combined
+    return combined
@@ -1,8 +1,14 @@
 """Middleware for providing filesystem tools to an agent."""
 # ruff: noqa: E501
 
+import io
 import os
-from collections.abc import Awaitable, Callable, Sequence
+import re
+import sys
+from collections.abc import Awaitable, Callable, Iterator, Sequence
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
 from typing import Annotated, Literal, NotRequired
 
 from langchain.agents.middleware.types import (
@@ -19,20 +25,30 @@ from langgraph.types import Command
 from typing_extensions import TypedDict
 
 from ..backends import StateBackend
-from ..backends.protocol import BackendFactory, BackendProtocol, EditResult, WriteResult
+from ..backends.protocol import BackendFactory, BackendProtocol, EditResult, FileInfo, WriteResult
 from ..backends.utils import (
     format_content_with_line_numbers,
     format_grep_matches,
     sanitize_tool_call_id,
     truncate_if_too_long,
 )
+from ._utils import append_system_prompt
 
 EMPTY_CONTENT_WARNING = "System reminder: File exists but has empty contents"
 MAX_LINE_LENGTH = 2000
 LINE_NUMBER_WIDTH = 6
 DEFAULT_READ_OFFSET = 0
 DEFAULT_READ_LIMIT = 500
+# Line limit for reads that need the whole file
+_FULL_READ_LIMIT = sys.maxsize
 BACKEND_TYPES = BackendProtocol | BackendFactory
+_PATH_GETTER = itemgetter("path")
+_SECTION_NUMBER_GETTER = itemgetter("section_number")
+_UNSAFE_PATH_RE = re.compile(r"\.\.|^~")
+_SLUG_SEPARATOR_RE = re.compile(r"[\W_]+")
+# ASCII fast path for slugs: alphanumeric bytes are kept, every other byte becomes a dash
+_ASCII_SLUG_TABLE = bytes(b if chr(b).isalnum() else ord("-") for b in range(128)) + b"-" * 128
+_ASCII_DASH_RUN_RE = re.compile(rb"-{2,}")
 
 
 class FileData(TypedDict):
@@ -112,7 +128,7 @@ def _validate_path(path: str, *, allowed_prefixes: Sequence[str] | None = None)
         validate_path("/etc/file.txt", allowed_prefixes=["/data/"])  # Raises ValueError
         ```
     """
-    if ".." in path or path.startswith("~"):
+    if _UNSAFE_PATH_RE.search(path):
         msg = f"Path traversal not allowed: {path}"
         raise ValueError(msg)
 
@@ -122,13 +138,20 @@ def _validate_path(path: str, *, allowed_prefixes: Sequence[str] | None = None)
     if not normalized.startswith("/"):
         normalized = f"/{normalized}"
 
-    if allowed_prefixes is not None and not any(normalized.startswith(prefix) for prefix in allowed_prefixes):
+    if allowed_prefixes is not None and not normalized.startswith(
+        allowed_prefixes if isinstance(allowed_prefixes, tuple) else tuple(allowed_prefixes)
+    ):
         msg = f"Path must start with one of {allowed_prefixes}: {path}"
         raise ValueError(msg)
 
     return normalized
 
 
+# Memoized validation for paths that recur across calls (e.g. the section files of
+# repeated aggregations). Invalid paths raise and are therefore never cached.
+_validate_path_cached = lru_cache(maxsize=1024)(_validate_path)
+
+
 class FilesystemState(AgentState):
     """State for the filesystem middleware."""
 
@@ -224,19 +247,82 @@ All file paths must start with a /.
 - grep: search for text within files"""
 
 
-def _get_backend(backend: BACKEND_TYPES, runtime: ToolRuntime) -> BackendProtocol:
-    """Get the resolved backend instance from backend or factory.
+def _strip_line_number_prefix(line: str) -> str:
+    """Remove a `cat -n` style prefix (e.g. `"     5\t"` or `"   5.1\t"`) from one line.
+
+    The prefix is optional whitespace, a line number (possibly with a decimal
+    continuation marker), then a tab. Lines without that prefix are returned as-is.
+    """
+    tab = line.find("\t")
+    if tab > 0:
+        number, dot, continuation = line[:tab].lstrip().partition(".")
+        if number.isdecimal() and (not dot or continuation.isdecimal()):
+            return line[tab + 1 :]
+    return line
+
+
+def _strip_line_numbers(content: str) -> str:
+    """Remove the line-number prefixes that backend reads add to every line."""
+    return "\n".join([_strip_line_number_prefix(line) for line in content.split("\n")])
+
+
+def _iter_lines(text: str) -> Iterator[str]:
+    """Lazily yield the lines of `text` as `str.splitlines()` would, without splitting it all up front."""
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        if end == -1:
+            end = len(text)
+        # splitlines() handles the other boundaries ("\r\n", "\r", ...); an empty segment is an empty line
+        yield from text[start:end].splitlines() or ("",)
+        start = end + 1
+
+
+def _head_lines(text: str, n: int) -> list[str]:
+    """Return the first `n` lines of `text`, scanning only as far as needed."""
+    return list(islice(_iter_lines(text), n))
+
+
+def _slugify(title: str) -> str:
+    """Turn a heading into a Markdown anchor, collapsing non-alphanumeric runs into one dash.
+
+    ASCII titles go through a byte translation table; anything else uses the
+    Unicode-aware pattern so non-ASCII letters are kept in the anchor.
+    """
+    lowered = title.lower()
+    if lowered.isascii():
+        slug = _ASCII_DASH_RUN_RE.sub(b"-", lowered.encode("ascii").translate(_ASCII_SLUG_TABLE))
+        return slug.strip(b"-").decode("ascii")
+    return _SLUG_SEPARATOR_RE.sub("-", lowered).strip("-")
+
+
+def _paths_from_infos(infos: list[FileInfo]) -> list[str]:
+    """Extract the path of every FileInfo entry.
+
+    `path` is the only required FileInfo key, so the C-level getter handles the
+    common case; entries missing it fall back to an empty string.
+    """
+    try:
+        return list(map(_PATH_GETTER, infos))
+    except KeyError:
+        return [fi.get("path", "") for fi in infos]
+
+
+def _backend_resolver(backend: BACKEND_TYPES) -> BackendFactory:
+    """Return a callable that resolves the backend for a tool runtime.
+
+    The instance-vs-factory decision is made once when the tool is generated
+    rather than on every tool invocation.
 
     Args:
         backend: Backend instance or factory function.
-        runtime: The tool runtime context.
 
     Returns:
-        Resolved backend instance.
+        Factory taking the tool runtime and returning the backend instance.
     """
     if callable(backend):
-        return backend(runtime)
-    return backend
+        return backend
+    return lambda _runtime: backend
 
 
 def _ls_tool_generator(
@@ -253,13 +339,14 @@ def _ls_tool_generator(
         Configured ls tool that lists files using the backend.
     """
     tool_description = custom_description or LIST_FILES_TOOL_DESCRIPTION
+    get_backend = _backend_resolver(backend)
 
     @tool(description=tool_description)
     def ls(runtime: ToolRuntime[None, FilesystemState], path: str) -> list[str]:
-        resolved_backend = _get_backend(backend, runtime)
+        resolved_backend = get_backend(runtime)
         validated_path = _validate_path(path)
         infos = resolved_backend.ls_info(validated_path)
-        return [fi.get("path", "") for fi in infos]
+        return _paths_from_infos(infos)
 
     return ls
 
@@ -278,6 +365,7 @@ def _read_file_tool_generator(
         Configured read_file tool that reads files using the backend.
     """
     tool_description = custom_description or READ_FILE_TOOL_DESCRIPTION
+    get_backend = _backend_resolver(backend)
 
     @tool(description=tool_description)
     def read_file(
@@ -286,7 +374,7 @@ def _read_file_tool_generator(
         offset: int = DEFAULT_READ_OFFSET,
         limit: int = DEFAULT_READ_LIMIT,
     ) -> str:
-        resolved_backend = _get_backend(backend, runtime)
+        resolved_backend = get_backend(runtime)
         file_path = _validate_path(file_path)
         return resolved_backend.read(file_path, offset=offset, limit=limit)
 
@@ -307,6 +395,7 @@ def _write_file_tool_generator(
         Configured write_file tool that creates new files using the backend.
     """
     tool_description = custom_description or WRITE_FILE_TOOL_DESCRIPTION
+    get_backend = _backend_resolver(backend)
 
     @tool(description=tool_description)
     def write_file(
@@ -314,11 +403,12 @@ def _write_file_tool_generator(
         content: str,
         runtime: ToolRuntime[None, FilesystemState],
     ) -> Command | str:
-        resolved_backend = _get_backend(backend, runtime)
+        resolved_backend = get_backend(runtime)
         file_path = _validate_path(file_path)
         res: WriteResult = resolved_backend.write(file_path, content)
         if res.error:
             return res.error
+        msg = f"Updated file {res.path}"
         # If backend returns state update, wrap into Command with ToolMessage
         if res.files_update is not None:
             return Command(
@@ -326,13 +416,13 @@ def _write_file_tool_generator(
                     "files": res.files_update,
                     "messages": [
                         ToolMessage(
-                            content=f"Updated file {res.path}",
+                            content=msg,
                             tool_call_id=runtime.tool_call_id,
                         )
                     ],
                 }
             )
-        return f"Updated file {res.path}"
+        return msg
 
     return write_file
 
@@ -351,6 +441,7 @@ def _edit_file_tool_generator(
         Configured edit_file tool that performs string replacements in files using the backend.
     """
     tool_description = custom_description or EDIT_FILE_TOOL_DESCRIPTION
+    get_backend = _backend_resolver(backend)
 
     @tool(description=tool_description)
     def edit_file(
@@ -361,24 +452,25 @@ def _edit_file_tool_generator(
         *,
         replace_all: bool = False,
     ) -> Command | str:
-        resolved_backend = _get_backend(backend, runtime)
+        resolved_backend = get_backend(runtime)
         file_path = _validate_path(file_path)
         res: EditResult = resolved_backend.edit(file_path, old_string, new_string, replace_all=replace_all)
         if res.error:
             return res.error
+        msg = f"Successfully replaced {res.occurrences} instance(s) of the string in '{res.path}'"
         if res.files_update is not None:
             return Command(
                 update={
                     "files": res.files_update,
                     "messages": [
                         ToolMessage(
-                            content=f"Successfully replaced {res.occurrences} instance(s) of the string in '{res.path}'",
+                            content=msg,
                             tool_call_id=runtime.tool_call_id,
                         )
                     ],
                 }
             )
-        return f"Successfully replaced {res.occurrences} instance(s) of the string in '{res.path}'"
+        return msg
 
     return edit_file
 
@@ -397,12 +489,13 @@ def _glob_tool_generator(
         Configured glob tool that finds files by pattern using the backend.
     """
     tool_description = custom_description or GLOB_TOOL_DESCRIPTION
+    get_backend = _backend_resolver(backend)
 
     @tool(description=tool_description)
     def glob(pattern: str, runtime: ToolRuntime[None, FilesystemState], path: str = "/") -> list[str]:
-        resolved_backend = _get_backend(backend, runtime)
+        resolved_backend = get_backend(runtime)
         infos = resolved_backend.glob_info(pattern, path=path)
-        return [fi.get("path", "") for fi in infos]
+        return _paths_from_infos(infos)
 
     return glob
 
@@ -421,6 +514,7 @@ def _grep_tool_generator(
         Configured grep tool that searches for patterns in files using the backend.
     """
     tool_description = custom_description or GREP_TOOL_DESCRIPTION
+    get_backend = _backend_resolver(backend)
 
     @tool(description=tool_description)
     def grep(
@@ -430,7 +524,7 @@ def _grep_tool_generator(
         glob: str | None = None,
         output_mode: Literal["files_with_matches", "content", "count"] = "files_with_matches",
     ) -> str:
-        resolved_backend = _get_backend(backend, runtime)
+        resolved_backend = get_backend(runtime)
         raw = resolved_backend.grep_raw(pattern, path=path, glob=glob)
         if isinstance(raw, str):
             return raw
@@ -464,6 +558,7 @@ def _validate_json_tool_generator(
     
     If both are provided, file_path takes precedence (the file will be read and validated).
     """
+    get_backend = _backend_resolver(backend)
     
     @tool(description=tool_description)
     def validate_json(
@@ -474,51 +569,36 @@ def _validate_json_tool_generator(
         """Validate JSON syntax and structure."""
         import json
         
-        result_parts = []
+        buf = io.StringIO()
         json_content = ""
         
         # Determine the source of JSON content
         if file_path:
             # Read from file using the backend
             try:
-                resolved_backend = _get_backend(backend, runtime)
+                resolved_backend = get_backend(runtime)
                 validated_path = _validate_path(file_path)
-                formatted_content = resolved_backend.read(validated_path, offset=0, limit=100000)  # Read full file
+                formatted_content = resolved_backend.read(validated_path, offset=0, limit=_FULL_READ_LIMIT)
                 
                 # Strip line numbers from formatted content (format: "     1\t{...}")
                 # The filesystem backend returns content with line numbers like: "     1\t{...}"
                 # Line numbers are right-aligned in 6-char field, followed by tab
                 # Pattern: optional spaces, then digits (possibly with decimal like "5.1"), then tab
-                import re
-                lines = formatted_content.split('\n')
-                json_lines = []
-                # Regex to match line number prefix: optional spaces, then number (int or decimal), then tab
-                line_number_pattern = re.compile(r'^\s*\d+(\.\d+)?\t')
-                for line in lines:
-                    # Check if line starts with line number format
-                    if line_number_pattern.match(line):
-                        # Remove the line number prefix (everything up to and including the tab)
-                        content = line_number_pattern.sub('', line)
-                        json_lines.append(content)
-                    else:
-                        # No line number prefix, use line as-is
-                        json_lines.append(line)
-                
-                json_content = '\n'.join(json_lines)
-                result_parts.append(f"📄 Reading JSON from file: {file_path}")
-                result_parts.append("")
-            except Exception as e:
+                json_content = _strip_line_numbers(formatted_content)
+                buf.write(f"📄 Reading JSON from file: {file_path}\n")
+                buf.write("\n")
+            except (OSError, ValueError, KeyError) as e:
                 return f"❌ ERROR: Could not read file {file_path}: {str(e)}"
         elif json_string:
             # Use provided JSON string
             json_content = json_string
-            result_parts.append("📄 Validating provided JSON string")
-            result_parts.append("")
+            buf.write("📄 Validating provided JSON string\n")
+            buf.write("\n")
         else:
             return "❌ ERROR: Either 'json_string' or 'file_path' must be provided."
         
         # Validate the JSON content
-        if not json_content or not json_content.strip():
+        if not json_content or json_content.isspace():
             return "❌ ERROR: JSON content is empty or contains only whitespace. Please provide valid JSON."
         
         try:
@@ -579,45 +659,42 @@ def _validate_json_tool_generator(
                 validation_checks.append("✓ Valid JSON (primitive value)")
             
             # Success message
-            result_parts.append("✅ JSON is VALID")
-            result_parts.append("")
-            result_parts.append("Validation details:")
-            result_parts.extend(validation_checks)
+            buf.write("✅ JSON is VALID\n")
+            buf.write("\n")
+            buf.write("Validation details:\n")
+            buf.writelines(f"{check}\n" for check in validation_checks)
             
-            return "\n".join(result_parts)
+            return buf.getvalue().rstrip("\n")
             
         except json.JSONDecodeError as e:
             # Detailed error information
             error_msg = f"❌ JSON is INVALID"
-            result_parts.append(error_msg)
-            result_parts.append("")
-            result_parts.append(f"Error: {e.msg}")
-            result_parts.append(f"Location: Line {e.lineno}, Column {e.colno}")
+            buf.write(f"{error_msg}\n")
+            buf.write("\n")
+            buf.write(f"Error: {e.msg}\n")
+            buf.write(f"Location: Line {e.lineno}, Column {e.colno}\n")
             
             # Show the problematic line if possible
             if e.lineno and json_content:
                 lines = json_content.split('\n')
                 if e.lineno <= len(lines):
                     problem_line = lines[e.lineno - 1]
-                    result_parts.append(f"Problem line: {problem_line}")
+                    buf.write(f"Problem line: {problem_line}\n")
                     # Show pointer to the column
                     if e.colno:
                         pointer = " " * (e.colno - 1) + "^"
-                        result_parts.append(f"            {pointer}")
+                        buf.write(f"            {pointer}\n")
             
-            result_parts.append("")
-            result_parts.append("Common JSON errors to check:")
-            result_parts.append("  - Missing or extra commas")
-            result_parts.append("  - Unclosed braces {} or brackets []")
-            result_parts.append("  - Unescaped quotes in strings")
-            result_parts.append("  - Trailing commas (not allowed in JSON)")
-            result_parts.append("  - Single quotes instead of double quotes")
-            result_parts.append("  - Unquoted property names")
+            buf.write("\n")
+            buf.write("Common JSON errors to check:\n")
+            buf.write("  - Missing or extra commas\n")
+            buf.write("  - Unclosed braces {} or brackets []\n")
+            buf.write("  - Unescaped quotes in strings\n")
+            buf.write("  - Trailing commas (not allowed in JSON)\n")
+            buf.write("  - Single quotes instead of double quotes\n")
+            buf.write("  - Unquoted property names\n")
             
-            return "\n".join(result_parts)
-        
-        except Exception as e:
-            return f"❌ Unexpected error during validation: {str(e)}"
+            return buf.getvalue().rstrip("\n")
     
     return validate_json
 
@@ -652,6 +729,7 @@ def _aggregate_document_tool_generator(
     CRITICAL: This tool uses the LangGraph filesystem backend. All file paths must be absolute paths starting with "/".
     The tool will read section files from the backend and write the aggregated document to the backend.
     """
+    get_backend = _backend_resolver(backend)
     
     @tool(description=tool_description)
     def aggregate_document(
@@ -666,7 +744,7 @@ def _aggregate_document_tool_generator(
         if not sections:
             raise ValueError("No sections provided to aggregate_document.")
         
-        resolved_backend = _get_backend(backend, runtime)
+        resolved_backend = get_backend(runtime)
         
         normalized_sections: list[dict[str, Any]] = []
         for idx, entry in enumerate(sections):
@@ -683,7 +761,7 @@ def _aggregate_document_tool_generator(
                 raise ValueError(
                     f"Section #{idx} has non-integer section_number: {entry['section_number']!r}"
                 ) from None
-            file_path = _validate_path(entry["file"])
+            file_path = _validate_path_cached(entry["file"])
             title = entry.get("title") or f"Section {number}"
             normalized_sections.append(
                 {
@@ -693,57 +771,55 @@ def _aggregate_document_tool_generator(
                 }
             )
         
-        normalized_sections.sort(key=lambda s: s["section_number"])
+        normalized_sections.sort(key=_SECTION_NUMBER_GETTER)
+        
+        # Read every section in one backend call when supported; sections missing from
+        # `contents` are read one by one below, so a failing file can be named
+        contents: dict[str, str] = {}
+        if hasattr(resolved_backend, "read_many"):
+            try:
+                contents = resolved_backend.read_many(
+                    [section["file"] for section in normalized_sections], offset=0, limit=_FULL_READ_LIMIT
+                )
+            except (OSError, ValueError):
+                # The batch error does not say which file failed; the per-file reads will
+                contents = {}
         
-        aggregated_chunks: list[str] = []
+        # Slot 0 is reserved for the table of contents, filled once all sections are known;
+        # slots 1..n hold the formatted sections
+        final_parts: list[str] = [""] * (len(normalized_sections) + 1)
         toc_lines: list[str] = []
         
-        for section in normalized_sections:
+        for index, section in enumerate(normalized_sections, start=1):
             file_path: str = section["file"]
-            # Try to read the file using the backend
-            try:
-                # Read full file content (use large limit to get entire file)
-                content = resolved_backend.read(file_path, offset=0, limit=1000000)
-                
-                # Strip line numbers from content (backend formats with line numbers)
-                import re
-                lines = content.split('\n')
-                content_lines = []
-                line_number_pattern = re.compile(r'^\s*\d+(\.\d+)?\t')
-                for line in lines:
-                    if line_number_pattern.match(line):
-                        content = line_number_pattern.sub('', line)
-                        content_lines.append(content)
-                    else:
-                        content_lines.append(line)
-                
-                content = '\n'.join(content_lines).strip()
-                
-            except Exception as e:
-                raise ValueError(f"Section file not found or cannot be read: {file_path}. Error: {str(e)}")
+            # Pop the raw read so it can be freed once this section is formatted
+            content = contents.pop(file_path, None)
+            if content is None:
+                # Not batched, or listed more than once and its earlier read was already released
+                try:
+                    content = resolved_backend.read(file_path, offset=0, limit=_FULL_READ_LIMIT)
+                except (OSError, ValueError) as e:
+                    raise ValueError(f"Section file cannot be read: {file_path}. Error: {e}") from e
+            if content.startswith(("Error:", "Error reading file")):
+                # Backends report missing or unreadable files as an error string
+                raise ValueError(f"Section file not found or cannot be read: {file_path}. {content}")
+            
+            # Strip line numbers from content (backend formats with line numbers)
+            content = _strip_line_numbers(content).strip()
             
             title = section["title"]
-            aggregated_chunks.append(f"## {title}\n\n{content}\n\n")
+            final_parts[index] = f"## {title}\n\n{content}\n\n"
             
             if generate_table_of_contents:
-                # Simple slugify for anchor
-                anchor = "".join(ch.lower() if ch.isalnum() else "-" for ch in title)
-                while "--" in anchor:
-                    anchor = anchor.replace("--", "-")
-                anchor = anchor.strip("-") or f"section-{section['section_number']}"
+                anchor = _slugify(title) or f"section-{section['section_number']}"
                 toc_lines.append(f"{section['section_number']}. [{title}](#{anchor})")
         
-        final_parts: list[str] = []
         if generate_table_of_contents and toc_lines:
-            final_parts.append("# Table of Contents\n")
-            final_parts.extend(line + "\n" for line in toc_lines)
-            final_parts.append("\n")
-        
-        final_parts.extend(aggregated_chunks)
+            final_parts[0] = "# Table of Contents\n" + "\n".join(toc_lines) + "\n\n"
         final_content = "".join(final_parts)
         
         # Write output file using the backend
-        output_path = _validate_path(output_file)
+        output_path = _validate_path_cached(output_file)
         write_result = resolved_backend.write(output_path, final_content)
         
         if write_result.error:
@@ -867,6 +943,7 @@ class FilesystemMiddleware(AgentMiddleware):
 
         # Set system prompt (allow full override)
         self.system_prompt = system_prompt if system_prompt is not None else FILESYSTEM_SYSTEM_PROMPT
+        self._combined_prompt_cache: dict[str, str] = {}
 
         self.tools = _get_filesystem_tools(self.backend, custom_tool_descriptions)
 
@@ -898,7 +975,7 @@ class FilesystemMiddleware(AgentMiddleware):
             The model response from the handler.
         """
         if self.system_prompt is not None:
-            request.system_prompt = request.system_prompt + "\n\n" + self.system_prompt if request.system_prompt else self.system_prompt
+            request.system_prompt = append_system_prompt(self._combined_prompt_cache, request.system_prompt, self.system_prompt)
         return handler(request)
 
     async def awrap_model_call(
@@ -916,7 +993,7 @@ class FilesystemMiddleware(AgentMiddleware):
             The model response from the handler.
         """
         if self.system_prompt is not None:
-            request.system_prompt = request.system_prompt + "\n\n" + self.system_prompt if request.system_prompt else self.system_prompt
+            request.system_prompt = append_system_prompt(self._combined_prompt_cache, request.system_prompt, self.system_prompt)
         return await handler(request)
 
     def _process_large_message(
@@ -933,7 +1010,7 @@ class FilesystemMiddleware(AgentMiddleware):
         result = resolved_backend.write(file_path, content)
         if result.error:
             return message, None
-        content_sample = format_content_with_line_numbers([line[:1000] for line in content.splitlines()[:10]], start_line=1)
+        content_sample = format_content_with_line_numbers([line[:1000] for line in _head_lines(content, 10)], start_line=1)
         processed_message = ToolMessage(
             TOO_LARGE_TOOL_MSG.format(
                 tool_call_id=message.tool_call_id,
@@ -945,8 +1022,10 @@ class FilesystemMiddleware(AgentMiddleware):
         return processed_message, result.files_update
 
     def _intercept_large_tool_result(self, tool_result: ToolMessage | Command, runtime: ToolRuntime) -> ToolMessage | Command:
-        if isinstance(tool_result, ToolMessage) and isinstance(tool_result.content, str):
-            if not (self.tool_token_limit_before_evict and len(tool_result.content) > 4 * self.tool_token_limit_before_evict):
+        threshold = 4 * (self.tool_token_limit_before_evict or 0)
+        if isinstance(tool_result, ToolMessage):
+            content = tool_result.content
+            if not (threshold and isinstance(content, str) and len(content) > threshold):
                 return tool_result
             resolved_backend = self._get_backend(runtime)
             processed_message, files_update = self._process_large_message(
@@ -969,25 +1048,32 @@ class FilesystemMiddleware(AgentMiddleware):
             if update is None:
                 return tool_result
             command_messages = update.get("messages", [])
-            accumulated_file_updates = dict(update.get("files", {}))
-            resolved_backend = self._get_backend(runtime)
+            # Copied lazily, only once a message is actually evicted
+            accumulated_file_updates: dict[str, FileData] | None = None
+            resolved_backend = None
             processed_messages = []
             for message in command_messages:
                 if not (
-                    self.tool_token_limit_before_evict
+                    threshold
                     and isinstance(message, ToolMessage)
                     and isinstance(message.content, str)
-                    and len(message.content) > 4 * self.tool_token_limit_before_evict
+                    and len(message.content) > threshold
                 ):
                     processed_messages.append(message)
                     continue
+                if resolved_backend is None:
+                    resolved_backend = self._get_backend(runtime)
                 processed_message, files_update = self._process_large_message(
                     message,
                     resolved_backend,
                 )
                 processed_messages.append(processed_message)
+                if accumulated_file_updates is None:
+                    accumulated_file_updates = dict(update.get("files", {}))
                 if files_update is not None:
                     accumulated_file_updates.update(files_update)
+            if accumulated_file_updates is None:
+                return tool_result
             return Command(update={**update, "messages": processed_messages, "files": accumulated_file_updates})
 
         return tool_result
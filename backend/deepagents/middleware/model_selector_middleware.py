@@ -1,7 +1,7 @@
 """Middleware to handle model selection from frontend config."""
 
-from typing import Any, Callable, Awaitable
-from langchain.agents.middleware.types import AgentMiddleware, AgentState, ModelRequest, ModelResponse
+from typing import Any
+from langchain.agents.middleware.types import AgentMiddleware, AgentState
 from langgraph.runtime import Runtime
 from backend.config import get_model, get_available_models
 from langchain_core.language_models import BaseChatModel
@@ -17,6 +17,21 @@ class ModelSelectorState(AgentState):
 # Cache for model instances to avoid recreating them
 _model_cache: dict[str, BaseChatModel] = {}
 
+# Model used when none (or an unknown one) is requested
+_DEFAULT_MODEL = "gpt-4o-mini"
+
+# Cache of available model names for O(1) membership checks
+_available_models_set: frozenset[str] | None = None
+
+
+def _get_available_models_set() -> frozenset[str]:
+    """Return the available model names as a frozenset, built once."""
+    global _available_models_set
+
+    if _available_models_set is None:
+        _available_models_set = frozenset(get_available_models())
+    return _available_models_set
+
 
 class ModelSelectorMiddleware(AgentMiddleware):
     """Middleware that handles model selection from frontend config.
@@ -24,16 +39,11 @@ class ModelSelectorMiddleware(AgentMiddleware):
     Model selection only works on the first message. Once set, it persists
     for the entire thread and cannot be changed.
     
-    This middleware intercepts model calls and replaces the model instance
-    with the selected model from state.
+    The selection is stored in state; model calls themselves are not wrapped.
     """
     
     state_schema = ModelSelectorState
     
-    def __init__(self):
-        """Initialize middleware."""
-        super().__init__()
-    
     def before_agent(self, state: AgentState, runtime: Runtime[Any]) -> dict[str, Any] | None:
         """Handle model selection from config (only on first message)."""
         # Check if model is already selected (from previous messages)
@@ -44,39 +54,20 @@ class ModelSelectorMiddleware(AgentMiddleware):
             return None
         
         # Check if model is specified in config (from frontend)
-        config = runtime.config if hasattr(runtime, "config") else {}
-        configurable = config.get("configurable", {})
+        try:
+            configurable = runtime.config.get("configurable", {}) or {}
+        except AttributeError:
+            configurable = {}
         requested_model = configurable.get("model")
         
         # Validate model name
         if requested_model:
-            available_models = get_available_models()
-            if requested_model in available_models:
+            if requested_model in _get_available_models_set():
                 # Set model in state (only on first message)
                 return {"selected_model": requested_model}
             else:
                 # Invalid model, use default
-                return {"selected_model": "gpt-4o-mini"}
+                return {"selected_model": _DEFAULT_MODEL}
         
         # No model specified, use default
-        return {"selected_model": "gpt-4o-mini"}
-    
-    async def awrap_model_call(
-        self,
-        request: ModelRequest,
-        handler: Callable[[ModelRequest], Awaitable[ModelResponse]],
-    ) -> ModelResponse:
-        """Intercept model calls and replace model with selected model from state."""
-        # Get the current state to check for selected model
-        # Note: We can't access state directly here, so we'll need to get it from runtime
-        # For now, we'll use the model from the request, but in the future we could
-        # intercept and replace it based on state
-        
-        # The actual model replacement would require access to the runtime/state,
-        # which is not directly available in awrap_model_call.
-        # For now, the model selection is stored in state and can be used
-        # by checking state in before_agent or by modifying the agent creation.
-        
-        # Call the handler with the original request
-        return await handler(request)
-
+        return {"selected_model": _DEFAULT_MODEL}
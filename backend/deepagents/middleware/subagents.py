@@ -1,12 +1,18 @@
 """Middleware for providing subagents to an agent via a `task` tool."""
 
+import asyncio
+import logging
+import threading
+import time
+import weakref
 from collections.abc import Awaitable, Callable, Sequence
-from copy import deepcopy
+from functools import lru_cache
 from typing import Any, NotRequired, TypedDict, cast
 
 from langchain.agents import create_agent
 from langchain.agents.middleware import HumanInTheLoopMiddleware, InterruptOnConfig
 from langchain.agents.middleware.types import AgentMiddleware, ModelRequest, ModelResponse
+from langchain.chat_models import init_chat_model
 from langchain.tools import BaseTool, ToolRuntime
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import HumanMessage, ToolMessage, AIMessage
@@ -14,6 +20,15 @@ from langchain_core.runnables import Runnable
 from langchain_core.tools import StructuredTool
 from langgraph.types import Command, Overwrite
 
+from ._utils import append_system_prompt
+
+try:
+    from backend.config.langfuse import get_langfuse_handler
+except ImportError:  # Langfuse is optional
+    get_langfuse_handler = None
+
+_log = logging.getLogger(__name__)
+
 
 class SubAgent(TypedDict):
     """Specification for an agent.
@@ -45,6 +60,16 @@ class SubAgent(TypedDict):
     interrupt_on: NotRequired[dict[str, bool | InterruptOnConfig]]
     """The tool configs to use for the agent."""
 
+    cacheable: NotRequired[bool]
+    """Whether results may be reused for repeated calls with the same description.
+
+    The cache belongs to the task tool, so a result is reused across threads and users,
+    and regardless of the parent state (e.g. `files`) the original run saw.
+    """
+
+    cache_ttl: NotRequired[float]
+    """Seconds a cached result stays valid. Defaults to the lifetime of the task tool."""
+
 
 class CompiledSubAgent(TypedDict):
     """A pre-compiled agent spec."""
@@ -58,11 +83,27 @@ class CompiledSubAgent(TypedDict):
     runnable: Runnable
     """The Runnable to use for the agent."""
 
+    cacheable: NotRequired[bool]
+    """Whether results may be reused for repeated calls with the same description.
+
+    The cache belongs to the task tool, so a result is reused across threads and users,
+    and regardless of the parent state (e.g. `files`) the original run saw.
+    """
+
+    cache_ttl: NotRequired[float]
+    """Seconds a cached result stays valid. Defaults to the lifetime of the task tool."""
+
 
 DEFAULT_SUBAGENT_PROMPT = "In order to complete the objective that the user asks of you, you have access to a number of standard tools."
 
 # State keys that should be excluded when passing state to subagents
-_EXCLUDED_STATE_KEYS = ("messages", "todos")
+_EXCLUDED_STATE_KEYS = frozenset(("messages", "todos"))
+
+# Maximum number of cached subagent results kept per task tool
+_RESPONSE_CACHE_SIZE = 128
+
+# Sentinel for messages that have no `id` attribute at all
+_NO_ID = object()
 
 TASK_TOOL_DESCRIPTION = """Launch an ephemeral subagent to handle complex, multi-step independent tasks with isolated context windows.
 
@@ -206,6 +247,99 @@ When NOT to use the task tool:
 DEFAULT_GENERAL_PURPOSE_DESCRIPTION = "General-purpose agent for researching complex questions, searching for files and content, and executing multi-step tasks. When you are searching for a keyword or file and are not confident that you will find the right match in the first few tries use this agent to perform the search for you. This agent has access to all tools as the main agent."  # noqa: E501
 
 
+def _without_excluded_keys(state: dict[str, Any]) -> dict[str, Any]:
+    """Return a shallow copy of `state` without the keys in `_EXCLUDED_STATE_KEYS`."""
+    filtered = dict(state)
+    for key in _EXCLUDED_STATE_KEYS & filtered.keys():
+        del filtered[key]
+    return filtered
+
+
+def _unwrap_messages(messages_raw: Any) -> list:
+    """Return the message list of a `messages` state value.
+
+    The value may be wrapped in `Overwrite` or its JSON form (`{"__overwrite__": [...]}`);
+    anything that is not a list yields an empty list.
+    """
+    # Plain lists are by far the most common value, so check for them first
+    if isinstance(messages_raw, list):
+        return messages_raw
+    if isinstance(messages_raw, Overwrite):
+        return getattr(messages_raw, "value", None) or []
+    if isinstance(messages_raw, dict):
+        return messages_raw.get("__overwrite__") or []
+    return []
+
+
+def _message_content(message: Any) -> Any:
+    """Return the content of a message object or message dict."""
+    content = getattr(message, "content", None)
+    if content is not None:
+        return content
+    if isinstance(message, dict):
+        return message.get("content") or message.get("text") or ""
+    text = getattr(message, "text", None)
+    return text if text is not None else str(message)
+
+
+@lru_cache(maxsize=32)
+def _format_task_description(template: str, available_agents: str) -> str:
+    """Fill the `{available_agents}` placeholder, reusing earlier renders of the same pair."""
+    return template.format(available_agents=available_agents)
+
+
+# Compiled subagent graphs keyed by the identity of everything passed to `create_agent`.
+# Values are weak so an entry disappears together with the last task tool using it,
+# which also keeps the id()-based keys from ever pointing at a recycled object.
+_SUBAGENT_CACHE: "weakref.WeakValueDictionary[tuple, Runnable]" = weakref.WeakValueDictionary()
+
+
+def clear_subagent_cache() -> None:
+    """Drop all memoized subagent graphs."""
+    _SUBAGENT_CACHE.clear()
+
+
+@lru_cache(maxsize=None)
+def _init_subagent_model(model: str) -> BaseChatModel:
+    """Resolve a model identifier once so every subagent using it shares one instance."""
+    return init_chat_model(model)
+
+
+@lru_cache(maxsize=1)
+def _cached_langfuse_handler() -> Any:
+    """Build the Langfuse callback handler once instead of per subagent invocation."""
+    return get_langfuse_handler() if get_langfuse_handler is not None else None
+
+
+def _compile_subagent(
+    model: str | BaseChatModel,
+    system_prompt: str,
+    tools: Sequence[BaseTool | Callable | dict[str, Any]],
+    middleware: list[AgentMiddleware],
+    interrupt_on: dict[str, bool | InterruptOnConfig] | None,
+) -> Runnable:
+    """Return a compiled subagent, reusing a previous build of the same spec."""
+    key = (
+        model if isinstance(model, str) else id(model),
+        system_prompt,
+        tuple(map(id, tools)),
+        tuple(map(id, middleware)),
+        repr(interrupt_on) if interrupt_on else None,
+    )
+    agent = _SUBAGENT_CACHE.get(key)
+    if agent is None:
+        if interrupt_on:
+            middleware = [*middleware, HumanInTheLoopMiddleware(interrupt_on=interrupt_on)]
+        agent = create_agent(
+            _init_subagent_model(model) if isinstance(model, str) else model,
+            system_prompt=system_prompt,
+            tools=tools,
+            middleware=middleware,
+        )
+        _SUBAGENT_CACHE[key] = agent
+    return agent
+
+
 def _get_subagents(
     *,
     default_model: str | BaseChatModel,
@@ -239,16 +373,13 @@ def _get_subagents(
 
     # Create general-purpose agent if enabled
     if general_purpose_agent:
-        general_purpose_middleware = [*default_subagent_middleware]
-        if default_interrupt_on:
-            general_purpose_middleware.append(HumanInTheLoopMiddleware(interrupt_on=default_interrupt_on))
-        general_purpose_subagent = create_agent(
+        agents["general-purpose"] = _compile_subagent(
             default_model,
-            system_prompt=DEFAULT_SUBAGENT_PROMPT,
-            tools=default_tools,
-            middleware=general_purpose_middleware,
+            DEFAULT_SUBAGENT_PROMPT,
+            default_tools,
+            default_subagent_middleware,
+            default_interrupt_on,
         )
-        agents["general-purpose"] = general_purpose_subagent
         subagent_descriptions.append(f"- general-purpose: {DEFAULT_GENERAL_PURPOSE_DESCRIPTION}")
 
     # Process custom subagents
@@ -258,21 +389,20 @@ def _get_subagents(
             custom_agent = cast("CompiledSubAgent", agent_)
             agents[custom_agent["name"]] = custom_agent["runnable"]
             continue
-        _tools = agent_.get("tools", list(default_tools))
+        _tools = agent_["tools"] if "tools" in agent_ else default_tools
 
         subagent_model = agent_.get("model", default_model)
 
-        _middleware = [*default_subagent_middleware, *agent_["middleware"]] if "middleware" in agent_ else [*default_subagent_middleware]
+        _middleware = [*default_subagent_middleware, *agent_["middleware"]] if "middleware" in agent_ else default_subagent_middleware
 
         interrupt_on = agent_.get("interrupt_on", default_interrupt_on)
-        if interrupt_on:
-            _middleware.append(HumanInTheLoopMiddleware(interrupt_on=interrupt_on))
 
-        agents[agent_["name"]] = create_agent(
+        agents[agent_["name"]] = _compile_subagent(
             subagent_model,
-            system_prompt=agent_["system_prompt"],
-            tools=_tools,
-            middleware=_middleware,
+            agent_["system_prompt"],
+            _tools,
+            _middleware,
+            interrupt_on,
         )
     return agents, subagent_descriptions
 
@@ -286,6 +416,7 @@ def _create_task_tool(
     subagents: list[SubAgent | CompiledSubAgent],
     general_purpose_agent: bool,
     task_description: str | None = None,
+    max_concurrent_subagents: int | None = None,
 ) -> BaseTool:
     """Create a task tool for invoking subagents.
 
@@ -299,6 +430,9 @@ def _create_task_tool(
         general_purpose_agent: Whether to include general-purpose agent.
         task_description: Custom description for the task tool. If `None`,
             uses default template. Supports `{available_agents}` placeholder.
+        max_concurrent_subagents: Upper bound on subagents running at once, applied
+            separately to the sync and async paths. If `None`, parallel `task` calls
+            are not throttled.
 
     Returns:
         A StructuredTool that can invoke subagents by type.
@@ -312,6 +446,52 @@ def _create_task_tool(
         general_purpose_agent=general_purpose_agent,
     )
     subagent_description_str = "\n".join(subagent_descriptions)
+    # Parallel `task` calls are dispatched concurrently by the ToolNode (through `atask`
+    # on the event loop, or `task` on its thread pool); the semaphores only cap fan-out
+    # so provider rate limits are not hammered.
+    subagent_semaphore = asyncio.Semaphore(max_concurrent_subagents) if max_concurrent_subagents else None
+    subagent_thread_semaphore = threading.BoundedSemaphore(max_concurrent_subagents) if max_concurrent_subagents else None
+    # Opt-in result cache for subagents marked `cacheable`, keyed on (subagent_type, description).
+    # Only the final transcript is kept: replaying other state keys (e.g. `files`) would
+    # overwrite anything the parent changed since the cached run
+    cache_ttls = {spec["name"]: spec.get("cache_ttl") for spec in subagents if spec.get("cacheable")}
+    response_cache: dict[tuple[str, str], tuple[float | None, list]] = {}
+    # Sync `task` calls run on the ToolNode's thread pool and share the cache
+    response_cache_lock = threading.Lock()
+
+    def _response_cache_key(subagent_type: str, description: str) -> tuple[str, str]:
+        # Whitespace-only differences in the description should still hit
+        return subagent_type, " ".join(description.split())
+
+    def _get_cached_messages(subagent_type: str, description: str) -> list | None:
+        """Return the cached final messages of a subagent run that is still valid, if any."""
+        if subagent_type not in cache_ttls:
+            return None
+        key = _response_cache_key(subagent_type, description)
+        with response_cache_lock:
+            entry = response_cache.get(key)
+            if entry is None:
+                return None
+            expires_at, messages = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                response_cache.pop(key, None)
+                return None
+            return messages
+
+    def _cache_messages(subagent_type: str, description: str, result: dict | None) -> None:
+        """Remember the final messages of a subagent run if its spec opted into caching."""
+        if subagent_type not in cache_ttls or not result:
+            return
+        messages = result.get("messages")
+        if not messages:
+            return
+        ttl = cache_ttls[subagent_type]
+        key = _response_cache_key(subagent_type, description)
+        with response_cache_lock:
+            if len(response_cache) >= _RESPONSE_CACHE_SIZE:
+                # Evict the oldest entry (dicts preserve insertion order)
+                response_cache.pop(next(iter(response_cache), None), None)
+            response_cache[key] = (time.monotonic() + ttl if ttl else None, messages)
 
     def _extract_subagent_tool_calls(messages: list) -> list[dict[str, Any]]:
         """Extract tool calls from sub-agent messages for frontend visualization.
@@ -322,117 +502,94 @@ def _create_task_tool(
         Returns:
             List of tool call dictionaries with name, args, id, and result (if available)
         """
-        import json
-        import logging
-        from langchain_core.messages import ToolMessage
+        return _scan_subagent_messages(messages)[0]
+
+    def _scan_subagent_messages(messages: list) -> tuple[list[dict[str, Any]], bool, bool]:
+        """Extract tool calls like `_extract_subagent_tool_calls` in the same pass that
+        checks the message types.
         
+        Returns:
+            Tuple of (tool calls, whether any AIMessage was seen, whether any ToolMessage was seen)
+        """
+        has_ai_message = False
+        has_tool_message = False
         tool_calls = []
         tool_call_results = {}  # Map tool_call_id -> result
+        seen_ids = set()  # Calls mirrored in additional_kwargs["tool_calls"] are only reported once
         
-        # First pass: extract tool call results from ToolMessages
-        for msg in messages:
-            if isinstance(msg, ToolMessage):
-                tool_call_id = getattr(msg, "tool_call_id", None)
-                if tool_call_id:
-                    # Get result content
-                    result_content = ""
-                    if hasattr(msg, "content"):
-                        result_content = msg.content
-                    elif hasattr(msg, "text"):
-                        result_content = msg.text
-                    elif isinstance(msg, dict):
-                        result_content = msg.get("content", msg.get("text", ""))
-                    else:
-                        result_content = str(msg)
-                    
-                    tool_call_results[tool_call_id] = result_content
+        def _add_tool_call(tc_id, tc_name, tc_args) -> None:
+            if tc_id in seen_ids:
+                return
+            seen_ids.add(tc_id)
+            # Raw JSON argument strings are passed through as-is; the frontend
+            # parses string args when a tool call is rendered
+            tool_calls.append({"id": tc_id, "name": tc_name, "args": tc_args})
         
-        # Second pass: extract tool calls from AIMessages and match with results
+        # Single pass: collect results from ToolMessages and calls from AIMessages,
+        # results are joined in afterwards since a ToolMessage follows its AIMessage
         for idx, msg in enumerate(messages):
-            if isinstance(msg, AIMessage):
-                logging.info(
-                    f"[SubAgent] _extract_subagent_tool_calls: Processing AIMessage {idx}, "
-                    f"has_tool_calls={hasattr(msg, 'tool_calls') and bool(msg.tool_calls)}, "
-                    f"tool_calls_count={len(msg.tool_calls) if hasattr(msg, 'tool_calls') and msg.tool_calls else 0}, "
-                    f"has_additional_kwargs={hasattr(msg, 'additional_kwargs') and bool(msg.additional_kwargs)}"
-                )
+            # Exact type checks cover the common case; isinstance only runs for subclasses
+            msg_type = type(msg)
+            if msg_type is ToolMessage or (msg_type is not AIMessage and isinstance(msg, ToolMessage)):
+                has_tool_message = True
+                tool_call_id = msg.tool_call_id
+                if tool_call_id:
+                    tool_call_results[tool_call_id] = msg.content
+            elif msg_type is AIMessage or isinstance(msg, AIMessage):
+                has_ai_message = True
+                msg_tool_calls = msg.tool_calls
+                additional_kwargs = msg.additional_kwargs
+                if _log.isEnabledFor(logging.INFO):
+                    _log.info(
+                        "[SubAgent] _extract_subagent_tool_calls: Processing AIMessage %d, "
+                        "has_tool_calls=%s, tool_calls_count=%d, has_additional_kwargs=%s",
+                        idx,
+                        bool(msg_tool_calls),
+                        len(msg_tool_calls) if msg_tool_calls else 0,
+                        bool(additional_kwargs),
+                    )
                 # Extract tool calls from AI messages
-                if hasattr(msg, 'tool_calls') and msg.tool_calls:
-                    for tc in msg.tool_calls:
-                        # Handle different tool call formats
-                        if isinstance(tc, dict):
-                            tc_id = tc.get('id') or f"subagent-tool-{len(tool_calls)}"
-                            tc_name = tc.get('name', 'unknown')
-                            tc_args = tc.get('args', {})
-                        else:
-                            tc_id = getattr(tc, 'id', None) or f"subagent-tool-{len(tool_calls)}"
-                            tc_name = getattr(tc, 'name', None) or 'unknown'
-                            tc_args = getattr(tc, 'args', None) or {}
-                        
-                        # Parse args if it's a string (JSON)
-                        if isinstance(tc_args, str):
-                            try:
-                                tc_args = json.loads(tc_args)
-                            except (json.JSONDecodeError, TypeError):
-                                pass  # Keep as string if not valid JSON
-                        
-                        tool_call_dict = {
-                            "id": tc_id,
-                            "name": tc_name,
-                            "args": tc_args,
-                        }
-                        
-                        # Add result if available
-                        if tc_id in tool_call_results:
-                            tool_call_dict["result"] = tool_call_results[tc_id]
-                            tool_call_dict["status"] = "completed"
-                        else:
-                            tool_call_dict["status"] = "pending"
-                        
-                        tool_calls.append(tool_call_dict)
+                for tc in msg_tool_calls or ():
+                    # Handle different tool call formats
+                    if isinstance(tc, dict):
+                        _add_tool_call(
+                            tc.get("id") or f"subagent-tool-{len(tool_calls)}",
+                            tc.get("name", "unknown"),
+                            tc.get("args", {}),
+                        )
+                    else:
+                        _add_tool_call(
+                            getattr(tc, "id", None) or f"subagent-tool-{len(tool_calls)}",
+                            getattr(tc, "name", None) or "unknown",
+                            getattr(tc, "args", None) or {},
+                        )
                 
                 # Also check additional_kwargs for tool_calls
-                if hasattr(msg, 'additional_kwargs') and msg.additional_kwargs:
-                    if 'tool_calls' in msg.additional_kwargs:
-                        for tc in msg.additional_kwargs['tool_calls']:
-                            tc_id = tc.get('id') or f"subagent-tool-{len(tool_calls)}"
-                            tc_name = tc.get('function', {}).get('name') or tc.get('name', 'unknown')
-                            tc_args = tc.get('function', {}).get('arguments') or tc.get('args', {})
-                            
-                            # Parse args if it's a string (JSON)
-                            if isinstance(tc_args, str):
-                                try:
-                                    tc_args = json.loads(tc_args)
-                                except (json.JSONDecodeError, TypeError):
-                                    pass  # Keep as string if not valid JSON
-                            
-                            tool_call_dict = {
-                                "id": tc_id,
-                                "name": tc_name,
-                                "args": tc_args,
-                            }
-                            
-                            # Add result if available
-                            if tc_id in tool_call_results:
-                                tool_call_dict["result"] = tool_call_results[tc_id]
-                                tool_call_dict["status"] = "completed"
-                            else:
-                                tool_call_dict["status"] = "pending"
-                            
-                            tool_calls.append(tool_call_dict)
+                for tc in (additional_kwargs.get("tool_calls") if additional_kwargs else None) or ():
+                    function = tc.get("function", {})
+                    _add_tool_call(
+                        tc.get("id") or f"subagent-tool-{len(tool_calls)}",
+                        function.get("name") or tc.get("name", "unknown"),
+                        function.get("arguments") or tc.get("args", {}),
+                    )
+        
+        for tool_call_dict in tool_calls:
+            tc_id = tool_call_dict["id"]
+            # Add result if available
+            if tc_id in tool_call_results:
+                tool_call_dict["result"] = tool_call_results[tc_id]
+                tool_call_dict["status"] = "completed"
+            else:
+                tool_call_dict["status"] = "pending"
         
         # Log only summary, not full details
         if not tool_calls:
-            logging.warning(
-                f"[SubAgent] _extract_subagent_tool_calls: No tool calls extracted from {len(messages)} messages"
-        )
+            _log.warning("[SubAgent] _extract_subagent_tool_calls: No tool calls extracted from %d messages", len(messages))
         
-        return tool_calls
+        return tool_calls, has_ai_message, has_tool_message
 
     def _serialize_tool_calls(tool_calls: Any) -> list[dict[str, Any]]:
         """Convert tool_calls payloads (objects or dicts) into serializable dicts."""
-        import json
-        
         if not tool_calls:
             return []
         
@@ -452,11 +609,6 @@ def _create_task_tool(
                     tc_args = getattr(tc.function, "arguments", None)
                 if tc_args is None and hasattr(tc, "json_args"):
                     tc_args = getattr(tc, "json_args", None)
-            if isinstance(tc_args, str):
-                try:
-                    tc_args = json.loads(tc_args)
-                except (json.JSONDecodeError, TypeError):
-                    pass
             serialized_calls.append(
                 {
                     "id": tc_id,
@@ -466,133 +618,57 @@ def _create_task_tool(
             )
         return serialized_calls
     
-    def _strip_tool_calls_from_message(message: AIMessage) -> AIMessage:
-        """Return a deep copy of the message without tool call metadata.
+    def _strip_tool_calls_from_message(message: AIMessage, **extra_kwargs: Any) -> AIMessage:
+        """Return a shallow copy of the message without tool call metadata.
         
         OpenAI requires every tool_call to have a matching ToolMessage response.
         When we replay sub-agent AIMessages in the main thread we must remove
         the nested tool call payloads so the orchestrator doesn't try to satisfy
-        sub-agent tool calls itself.
+        sub-agent tool calls itself. Only `tool_calls` and `additional_kwargs`
+        change, so the (possibly large) content is shared instead of deep-copied.
         """
-        msg_copy = deepcopy(message)
-        serialized_calls = _serialize_tool_calls(getattr(msg_copy, "tool_calls", []))
-        if hasattr(msg_copy, "tool_calls"):
-            msg_copy.tool_calls = []
+        serialized_calls = _serialize_tool_calls(getattr(message, "tool_calls", []))
         
-        additional_kwargs = getattr(msg_copy, "additional_kwargs", None)
+        additional_kwargs = getattr(message, "additional_kwargs", None)
         if isinstance(additional_kwargs, dict):
-            additional_kwargs.pop("tool_calls", None)
-            additional_kwargs.pop("function_call", None)
-            msg_copy.additional_kwargs = additional_kwargs
+            additional_kwargs = {k: v for k, v in additional_kwargs.items() if k not in ("tool_calls", "function_call")}
         else:
-            msg_copy.additional_kwargs = {}
+            additional_kwargs = {}
         
         if serialized_calls:
-            msg_copy.additional_kwargs["_subagent_tool_calls"] = serialized_calls
+            additional_kwargs["_subagent_tool_calls"] = serialized_calls
+        additional_kwargs.update(extra_kwargs)
         
-        return msg_copy
+        return message.model_copy(update={"tool_calls": [], "additional_kwargs": additional_kwargs})
     
-    def _prepare_subagent_ai_message(
-        message: AIMessage,
-        *,
-        parent_tool_call_id: str,
-        subagent_type: str | None,
-    ) -> AIMessage:
-        """Create a sanitized AIMessage annotated with sub-agent metadata."""
-        msg_copy = _strip_tool_calls_from_message(message)
-        if not hasattr(msg_copy, "additional_kwargs") or msg_copy.additional_kwargs is None:
-            msg_copy.additional_kwargs = {}
-        msg_copy.additional_kwargs["_subagent_source"] = {
-            "tool_call_id": parent_tool_call_id,
-            "subagent_type": subagent_type,
-        }
-        return msg_copy
-
     def _return_command_with_state_update(result: dict, tool_call_id: str, subagent_type: str = None, accumulated_tool_calls_map: dict = None) -> Command:
-        state_update = {k: v for k, v in result.items() if k not in _EXCLUDED_STATE_KEYS}
+        # Fresh copy owned by this call, so it is filled in place and returned as the update
+        state_update = _without_excluded_keys(result)
+        
+        result_messages = result.get("messages")
         
         # Extract tool calls from sub-agent messages for frontend visualization
         subagent_tool_calls = []
-        if "messages" in result:
-            subagent_tool_calls = _extract_subagent_tool_calls(result["messages"])
-            # Tool calls extracted, no need to log details
+        if result_messages is not None:
+            subagent_tool_calls = _extract_subagent_tool_calls(result_messages)
         
         # Create ToolMessage with sub-agent tool calls in additional_kwargs
-        # Extract content from the last message (could be AIMessage, HumanMessage, etc.)
+        # Use the content of the last message that has any; normally that is the final
+        # response from the sub-agent, so the scan stops at the first item
         # This content becomes the toolCall.result in the frontend
-        tool_message_content = ""
-        if result.get("messages"):
-            last_msg = result["messages"][-1]
-            # Try different ways to get content
-            if hasattr(last_msg, "content"):
-                tool_message_content = last_msg.content
-            elif hasattr(last_msg, "text"):
-                tool_message_content = last_msg.text
-            elif isinstance(last_msg, dict):
-                tool_message_content = last_msg.get("content", last_msg.get("text", ""))
-            else:
-                tool_message_content = str(last_msg)
-        
-        # If we have multiple messages, try to get a summary or the final output
-        # The last message should be the final response from the sub-agent
-        if not tool_message_content and result.get("messages"):
-            # Try to get content from any message
-            for msg in reversed(result["messages"]):
-                if hasattr(msg, "content") and msg.content:
-                    tool_message_content = msg.content
-                    break
-                elif hasattr(msg, "text") and msg.text:
-                    tool_message_content = msg.text
-                    break
-        
-        import logging
-        logging.info(
-            f"[SubAgent] _return_command_with_state_update: Tool message content length={len(tool_message_content)}, "
-            f"has_tool_calls={len(subagent_tool_calls) > 0}, subagent_type={subagent_type}"
-        )
-        
-        # Include sub-agent tool calls in the message metadata for frontend
-        # This is critical - the frontend reads subagent_tool_calls from additional_kwargs
-        additional_kwargs = {}
-        if subagent_tool_calls:
-            additional_kwargs["subagent_tool_calls"] = subagent_tool_calls
-        if subagent_type:
-            additional_kwargs["subagent_type"] = subagent_type
-        
-        # Always set additional_kwargs as a dict (even if empty) to ensure it's preserved
-        # Some serializers might drop None values
-        tool_message = ToolMessage(
-            content=tool_message_content,
-            tool_call_id=tool_call_id,
-            additional_kwargs=additional_kwargs,  # Always pass dict, never None
-        )
-        
-        logging.info(
-            f"[SubAgent] Created ToolMessage: content_length={len(tool_message_content)}, "
-            f"has_additional_kwargs={bool(additional_kwargs)}, "
-            f"additional_kwargs_keys={list(additional_kwargs.keys()) if additional_kwargs else []}, "
-            f"tool_call_id={tool_call_id}"
-        )
-        
-        # Verify the ToolMessage has additional_kwargs set correctly
-        if hasattr(tool_message, "additional_kwargs"):
-            # additional_kwargs set correctly
-            pass
+        for msg in reversed(result_messages or ()):
+            tool_message_content = _message_content(msg)
+            if tool_message_content:
+                break
         else:
-            logging.warning("[SubAgent] ToolMessage does not have additional_kwargs attribute!")
-        
-        # CRITICAL: Only add the ToolMessage to the main thread's message history.
-        # Do NOT add sub-agent AIMessages to the main thread, as this breaks OpenAI's
-        # tool call validation (it expects ToolMessages immediately after AIMessages with tool_calls).
-        # Sub-agent AIMessages are only used for frontend streaming via stream_writer.
-        messages_to_add = [tool_message]  # Only the ToolMessage goes to main thread
+            tool_message_content = ""
         
-        # Also store sub-agent tool calls in state for reliable frontend access
-        # This is a fallback in case additional_kwargs is not preserved during serialization
-        update_dict = {
-                **state_update,
-            "messages": messages_to_add,  # Only ToolMessage, no sub-agent AIMessages
-        }
+        _log.info(
+            "[SubAgent] _return_command_with_state_update: Tool message content length=%d, has_tool_calls=%s, subagent_type=%s",
+            len(tool_message_content),
+            bool(subagent_tool_calls),
+            subagent_type,
+        )
         
         # Store sub-agent tool calls in state with key: subagent_tool_calls_map
         # Format: {tool_call_id: {"tool_calls": [...], "subagent_type": ...}}
@@ -616,15 +692,12 @@ def _create_task_tool(
         # CRITICAL: Build a map of tool call IDs to their ToolMessages for status updates
         # This ensures last few tools that arrived after streaming get their status updated
         tool_call_results = {}
-        if "messages" in result:
-            for msg in result["messages"]:
-                if isinstance(msg, ToolMessage):
-                    tool_call_id_from_msg = getattr(msg, "tool_call_id", None)
+        if result_messages is not None:
+            for msg in result_messages:
+                if type(msg) is ToolMessage or isinstance(msg, ToolMessage):
+                    tool_call_id_from_msg = msg.tool_call_id
                     if tool_call_id_from_msg:
-                        if hasattr(msg, "content"):
-                            tool_call_results[tool_call_id_from_msg] = msg.content
-                        elif hasattr(msg, "text"):
-                            tool_call_results[tool_call_id_from_msg] = msg.text
+                        tool_call_results[tool_call_id_from_msg] = msg.content
         
         # Merge tool calls from final result (if any) with accumulated ones
         if subagent_tool_calls:
@@ -681,36 +754,121 @@ def _create_task_tool(
                     merged_map[key] = value
                 else:
                     # This shouldn't happen, but log if it does
-                    import logging
-                    logging.warning(
-                        f"[SubAgent] _return_command_with_state_update: Unexpected tool_call_id in map: "
-                        f"expected={tool_call_id}, found={key}, subagent_type={subagent_type}"
+                    _log.warning(
+                        "[SubAgent] _return_command_with_state_update: Unexpected tool_call_id in map: expected=%s, found=%s, subagent_type=%s",
+                        tool_call_id,
+                        key,
+                        subagent_type,
                     )
             
             # Log to help debug tool call isolation issues, especially for parallel sub-agents
-            import logging
-            logging.info(
-                f"[SubAgent] _return_command_with_state_update: Updating tool calls map for tool_call_id={tool_call_id}, "
-                f"subagent_type={subagent_type}, "
-                f"tool_calls_count={len(tool_calls_map.get(tool_call_id, {}).get('tool_calls', []))}, "
-                f"existing_map_keys={list(existing_state_map.keys())}, "
-                f"merged_map_keys={list(merged_map.keys())}, "
-                f"parallel_subagents={len(existing_state_map) > 1}"
-            )
-            
-            update_dict["subagent_tool_calls_map"] = merged_map
+            if _log.isEnabledFor(logging.INFO):
+                _log.info(
+                    "[SubAgent] _return_command_with_state_update: Updating tool calls map for tool_call_id=%s, "
+                    "subagent_type=%s, tool_calls_count=%d, existing_map_keys=%s, merged_map_keys=%s, parallel_subagents=%s",
+                    tool_call_id,
+                    subagent_type,
+                    len(tool_calls_map.get(tool_call_id, {}).get("tool_calls", [])),
+                    list(existing_state_map),
+                    list(merged_map),
+                    len(existing_state_map) > 1,
+                )
             
+            state_update["subagent_tool_calls_map"] = merged_map
+        
+        # The frontend reads subagent_tool_calls from additional_kwargs and falls back to
+        # subagent_tool_calls_map[tool_call_id]. The map entry is kept current while
+        # streaming, so only embed the list in the ToolMessage when no map entry was written
+        additional_kwargs = {}
+        if subagent_tool_calls and tool_call_id not in state_update.get("subagent_tool_calls_map", ()):
+            additional_kwargs["subagent_tool_calls"] = subagent_tool_calls
+        if subagent_type:
+            additional_kwargs["subagent_type"] = subagent_type
         
-        return Command(update=update_dict)
+        # Always set additional_kwargs as a dict (even if empty) to ensure it's preserved
+        # Some serializers might drop None values
+        tool_message = ToolMessage(
+            content=tool_message_content,
+            tool_call_id=tool_call_id,
+            additional_kwargs=additional_kwargs,  # Always pass dict, never None
+        )
+        
+        if _log.isEnabledFor(logging.INFO):
+            _log.info(
+                "[SubAgent] Created ToolMessage: content_length=%d, has_additional_kwargs=%s, additional_kwargs_keys=%s, tool_call_id=%s",
+                len(tool_message_content),
+                bool(additional_kwargs),
+                list(additional_kwargs),
+                tool_call_id,
+            )
+        
+        # CRITICAL: Only add the ToolMessage to the main thread's message history.
+        # Do NOT add sub-agent AIMessages to the main thread, as this breaks OpenAI's
+        # tool call validation (it expects ToolMessages immediately after AIMessages with tool_calls).
+        # Sub-agent AIMessages are only used for frontend streaming via stream_writer.
+        state_update["messages"] = [tool_message]
+        
+        return Command(update=state_update)
+
+    def _take_unseen_messages(new_messages: list, seen_message_ids: set) -> list:
+        """Return the messages whose ids were not seen yet, recording their ids in one pass.
+        
+        Messages without an `id` attribute are skipped, unless none of them has one,
+        in which case all are treated as new (for backwards compatibility).
+        """
+        unseen = []
+        has_ids = False
+        for msg in new_messages:
+            msg_id = getattr(msg, "id", _NO_ID)
+            if msg_id is _NO_ID:
+                continue
+            has_ids = True
+            if msg_id not in seen_message_ids:
+                unseen.append(msg)
+                if msg_id:
+                    seen_message_ids.add(msg_id)
+        return unseen if has_ids else new_messages
+
+    def _state_tool_calls_map(runtime: ToolRuntime) -> dict:
+        """Return the parent's `subagent_tool_calls_map`, or an empty dict if it has none."""
+        try:
+            state_map = runtime.state.get("subagent_tool_calls_map") if runtime.state else None
+        except Exception:
+            return {}
+        return state_map if isinstance(state_map, dict) else {}
+
+    def _with_state_tool_calls_map(tool_calls_map: dict, runtime: ToolRuntime) -> dict:
+        """Add the entries of the parent's `subagent_tool_calls_map` that `tool_calls_map` lacks.
+        
+        Copy-on-write: `tool_calls_map` may already have been handed to `stream_writer`,
+        so a new dict is returned when entries are added, and the same one otherwise.
+        """
+        state_map = _state_tool_calls_map(runtime)
+        missing_keys = [key for key in state_map if key not in tool_calls_map]
+        if not missing_keys:
+            return tool_calls_map
+        merged = tool_calls_map.copy()
+        for key in missing_keys:
+            merged[key] = state_map[key]
+        return merged
+
+    def _streamed_tool_calls_map(tool_calls_map: dict, tool_call_id: str) -> dict:
+        """Return the part of `tool_calls_map` that belongs to the sub-agent call `tool_call_id`.
+        
+        The frontend merges streamed maps into its own by key, so each update only needs this
+        call's entry; the full map is still returned in the final state update.
+        """
+        entry = tool_calls_map.get(tool_call_id)
+        return {tool_call_id: entry} if entry is not None else {}
 
     def _validate_and_prepare_state(subagent_type: str, description: str, runtime: ToolRuntime) -> tuple[Runnable, dict]:
         """Validate subagent type and prepare state for invocation."""
-        if subagent_type not in subagent_graphs:
+        subagent = subagent_graphs.get(subagent_type)
+        if subagent is None:
             msg = f"Error: invoked agent of type {subagent_type}, the only allowed types are {[f'`{k}`' for k in subagent_graphs]}"
             raise ValueError(msg)
-        subagent = subagent_graphs[subagent_type]
         # Create a new state dict to avoid mutating the original
-        subagent_state = {k: v for k, v in runtime.state.items() if k not in _EXCLUDED_STATE_KEYS}
+        subagent_state = _without_excluded_keys(runtime.state)
         subagent_state["messages"] = [HumanMessage(content=description)]
         return subagent, subagent_state
     
@@ -727,17 +885,19 @@ def _create_task_tool(
         """
         callbacks = []
         try:
-            # Try to get callbacks from runtime config
-            if hasattr(runtime, "config") and runtime.config:
-                if isinstance(runtime.config, dict):
-                    callbacks = runtime.config.get("callbacks", [])
-                elif hasattr(runtime.config, "callbacks"):
-                    callbacks = runtime.config.callbacks or []
-                # Also check configurable.callbacks (LangGraph pattern)
-                if not callbacks and hasattr(runtime.config, "configurable"):
-                    configurable = runtime.config.configurable
-                    if isinstance(configurable, dict):
-                        callbacks = configurable.get("callbacks", [])
+            # Try to get callbacks from runtime config; it is normally a RunnableConfig
+            # dict, so the item lookup is tried first and attributes only on a miss
+            config = runtime.config
+            if config:
+                try:
+                    callbacks = config["callbacks"]
+                except (TypeError, KeyError):
+                    callbacks = getattr(config, "callbacks", None)
+                    # Also check configurable.callbacks (LangGraph pattern)
+                    if not callbacks:
+                        configurable = getattr(config, "configurable", None)
+                        if isinstance(configurable, dict):
+                            callbacks = configurable.get("callbacks")
         except Exception:
             pass
         
@@ -745,8 +905,7 @@ def _create_task_tool(
         # This ensures Langfuse can track token usage even if callbacks aren't in runtime config
         if not callbacks:
             try:
-                from backend.config.langfuse import get_langfuse_handler
-                langfuse_handler = get_langfuse_handler()
+                langfuse_handler = _cached_langfuse_handler()
                 if langfuse_handler:
                     callbacks = [langfuse_handler]
             except Exception:
@@ -756,310 +915,181 @@ def _create_task_tool(
 
     # Use custom description if provided, otherwise use default template
     if task_description is None:
-        task_description = TASK_TOOL_DESCRIPTION.format(available_agents=subagent_description_str)
+        task_description = _format_task_description(TASK_TOOL_DESCRIPTION, subagent_description_str)
     elif "{available_agents}" in task_description:
         # If custom description has placeholder, format with agent descriptions
-        task_description = task_description.format(available_agents=subagent_description_str)
+        task_description = _format_task_description(task_description, subagent_description_str)
 
     def task(
         description: str,
         subagent_type: str,
         runtime: ToolRuntime,
+    ) -> str | Command:
+        if subagent_thread_semaphore is None:
+            return _run_subagent(description, subagent_type, runtime)
+        with subagent_thread_semaphore:
+            return _run_subagent(description, subagent_type, runtime)
+
+    def _run_subagent(
+        description: str,
+        subagent_type: str,
+        runtime: ToolRuntime,
     ) -> str | Command:
         subagent, subagent_state = _validate_and_prepare_state(subagent_type, description, runtime)
         # Extract callbacks from runtime config to pass to sub-agent
         # This ensures Langfuse CallbackHandler receives LLM events from sub-agents
         callbacks = _get_callbacks_from_runtime(runtime)
         
-        if not runtime.tool_call_id:
+        tool_call_id = runtime.tool_call_id
+        if not tool_call_id:
             value_error_msg = "Tool call ID is required for subagent invocation"
             raise ValueError(value_error_msg)
+        # Resolved once instead of for every streamed batch
+        stream_writer = getattr(runtime, "stream_writer", None)
+        # One `_subagent_source` marker shared by every message this run streams; it is never mutated
+        subagent_source = {"tool_call_id": tool_call_id, "subagent_type": subagent_type}
+        
+        cached_messages = _get_cached_messages(subagent_type, description)
+        if cached_messages is not None:
+            # Only the ToolMessage and this call's tool-calls entry are rebuilt from the transcript
+            return _return_command_with_state_update({"messages": cached_messages}, tool_call_id, subagent_type=subagent_type)
         
         # Use stream to get real-time updates from sub-agent (sync version - no await)
         # Stream with "updates" mode to get state updates as they happen
         final_result = None
         accumulated_messages = []
         seen_message_ids = set()
-        # CRITICAL: Accumulate tool calls during streaming for THIS sub-agent only
-        # Each sub-agent invocation has a unique tool_call_id (runtime.tool_call_id)
-        # This map is keyed by tool_call_id, so it only contains tool calls for the current sub-agent
-        # When multiple sub-agents run in parallel, each has its own accumulated_tool_calls_map
-        accumulated_tool_calls_map = {}
+        # Ids of the tool calls already in this sub-agent's map entry
+        known_tool_call_ids = set()
         # CRITICAL: Accumulate tool calls during streaming for THIS sub-agent only
         # Each sub-agent invocation has a unique tool_call_id (runtime.tool_call_id)
         # This map is keyed by tool_call_id, so it only contains tool calls for the current sub-agent
         # When multiple sub-agents run in parallel, each has its own accumulated_tool_calls_map
         accumulated_tool_calls_map = {}
         
-        # Use both "updates" and "values" modes to get both incremental updates and full state
-        # "updates" gives us state deltas, "values" gives us full state including messages
+        # "updates" yields each node's state delta once, and the messages in it carry
+        # ids, so seen_message_ids is enough to dedup without a full "values" snapshot
         for chunk in subagent.stream(
-            subagent_state, 
+            subagent_state,
             config={"callbacks": callbacks} if callbacks else None,
-            stream_mode=["updates", "values"]
+            stream_mode="updates",
         ):
-            import logging
-            logging.info(
-                f"[SubAgent] task: Received chunk type={type(chunk).__name__}, "
-                f"chunk={chunk if not isinstance(chunk, dict) or len(str(chunk)) < 500 else 'dict (too large)'}"
-            )
-            
-            # When using multiple stream modes, chunks come as (stream_mode, chunk) tuples
-            # Handle both single mode (dict) and multiple modes (tuple) formats
-            stream_mode = None
-            chunk_data = None
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("[SubAgent] task: Received chunk type=%s", type(chunk).__name__)
             
-            if isinstance(chunk, tuple) and len(chunk) == 2:
-                # Format: (stream_mode, chunk_data)
-                stream_mode, chunk_data = chunk
-            elif isinstance(chunk, dict):
-                # Single mode: chunk is directly the data
-                chunk_data = chunk
-                stream_mode = "updates"  # Default assumption
-            else:
-                logging.warning(f"[SubAgent] task: Unknown chunk format: type={type(chunk).__name__}, chunk={chunk}")
-                continue
-            
-            # chunk_data should be a dict like {node_name: state_update}
-            if not isinstance(chunk_data, dict):
-                logging.warning(f"[SubAgent] task: chunk_data is not a dict: type={type(chunk_data).__name__}")
+            # With a single stream mode each chunk is a plain {node_name: state_update} dict
+            if not isinstance(chunk, dict):
+                _log.warning("[SubAgent] task: Unknown chunk format: type=%s, chunk=%r", type(chunk).__name__, chunk)
                 continue
             
-            items_to_process = list(chunk_data.items())
-            
             # Extract messages and tool calls from each update
-            for item in items_to_process:
-                if isinstance(item, tuple) and len(item) == 2:
-                    node_name, state_update = item
-                else:
-                    continue
-                    
-                
-                # Handle both "updates" (state deltas) and "values" (full state) modes
-                # In "values" mode, chunks come as (stream_mode, {node_name: value}) where node_name is the state key
-                # So if node_name is "messages", state_update IS the list of messages
-                # In "updates" mode, state_update is a dict with state deltas
-                if stream_mode == "values" and node_name == "messages":
-                    # In values mode, when node_name is "messages", state_update IS the list of messages
-                    # Handle Overwrite objects that might wrap the messages
-                    messages_raw = state_update
-                    
-                    # Extract actual value if it's wrapped in Overwrite
-                    if isinstance(messages_raw, Overwrite):
-                        new_messages = messages_raw.value if hasattr(messages_raw, "value") else []
-                    elif isinstance(messages_raw, dict) and "__overwrite__" in messages_raw:
-                        # Handle JSON format with __overwrite__ key
-                        new_messages = messages_raw["__overwrite__"]
-                    else:
-                        new_messages = messages_raw if isinstance(messages_raw, list) else []
-                    
-                    if new_messages:
-                            # Filter out messages we've already seen
-                            truly_new_messages = [
-                                msg for msg in new_messages
-                                if hasattr(msg, "id") and msg.id not in seen_message_ids
-                            ]
-                            if not any(hasattr(msg, "id") for msg in new_messages):
-                                truly_new_messages = new_messages
-                            
-                            if truly_new_messages:
-                                for msg in truly_new_messages:
-                                    if hasattr(msg, "id") and msg.id:
-                                        seen_message_ids.add(msg.id)
-                                accumulated_messages.extend(truly_new_messages)
-                                
-                                # Extract tool calls and update state (same as async version)
-                                subagent_tool_calls = _extract_subagent_tool_calls(truly_new_messages)
-                                if subagent_tool_calls or any(isinstance(msg, AIMessage) for msg in truly_new_messages):
-                                    try:
-                                        messages_to_add_to_main = []
-                                        for msg in truly_new_messages:
-                                            if isinstance(msg, AIMessage):
-                                                msg_copy = _prepare_subagent_ai_message(
-                                                    msg,
-                                                    parent_tool_call_id=runtime.tool_call_id,
-                                                    subagent_type=subagent_type,
-                                                )
-                                                messages_to_add_to_main.append(msg_copy)
-                                        
-                                        current_map = {}
-                                        try:
-                                            if hasattr(runtime, "state") and runtime.state:
-                                                current_map = runtime.state.get("subagent_tool_calls_map", {})
-                                                if not isinstance(current_map, dict):
-                                                    current_map = {}
-                                        except Exception:
-                                            pass
-                                        
-                                        if subagent_tool_calls:
-                                            if runtime.tool_call_id not in current_map:
-                                                current_map[runtime.tool_call_id] = {
-                                                    "tool_calls": [],
-                                                    "subagent_type": subagent_type,
-                                                }
-                                            existing_ids = {tc.get("id") for tc in current_map[runtime.tool_call_id].get("tool_calls", [])}
-                                            new_tool_calls = [tc for tc in subagent_tool_calls if tc.get("id") not in existing_ids]
-                                            current_map[runtime.tool_call_id]["tool_calls"].extend(new_tool_calls)
-                                        
-                                        if hasattr(runtime, "stream_writer") and runtime.stream_writer:
-                                            try:
-                                                stream_update = {
-                                                    f"subagent_{subagent_type}_{node_name}": {
-                                                        "messages": messages_to_add_to_main,
-                                                        "subagent_tool_calls_map": current_map,
-                                                    }
-                                                }
-                                                runtime.stream_writer(stream_update)
-                                                logging.info(
-                                                    f"[SubAgent] task: Streaming update from values mode: "
-                                                    f"Added {len(messages_to_add_to_main)} messages, "
-                                                    f"{len(subagent_tool_calls)} tool calls"
-                                                )
-                                            except Exception as e:
-                                                logging.warning(f"Failed to forward sub-agent streaming update: {e}", exc_info=True)
-                                    except Exception as e:
-                                        logging.error(f"Failed to update state during sub-agent streaming: {e}", exc_info=True)
-                    
-                    # Handle "updates" mode (state deltas)
-                elif stream_mode == "updates" and isinstance(state_update, dict) and "messages" in state_update:
+            for state_update in chunk.values():
+                if isinstance(state_update, dict) and "messages" in state_update:
                     # Get new messages from this update
                     # Note: state_update["messages"] might be the full list or just new messages
                     # We need to track which messages we've already seen
                     # Handle Overwrite objects that might wrap the messages
                     messages_raw = state_update.get("messages", [])
                     
-                    # Extract actual value if it's wrapped in Overwrite
-                    if isinstance(messages_raw, Overwrite):
-                        new_messages = messages_raw.value if hasattr(messages_raw, "value") else []
-                    elif isinstance(messages_raw, dict) and "__overwrite__" in messages_raw:
-                        # Handle JSON format with __overwrite__ key
-                        new_messages = messages_raw["__overwrite__"]
-                    else:
-                        new_messages = messages_raw if isinstance(messages_raw, list) else []
+                    new_messages = _unwrap_messages(messages_raw)
                     
                     if new_messages:
                         # Filter out messages we've already seen (to avoid duplicates)
-                        truly_new_messages = [
-                            msg for msg in new_messages
-                            if hasattr(msg, "id") and msg.id not in seen_message_ids
-                        ]
-                        
-                        # If no IDs, assume all are new (for backwards compatibility)
-                        if not any(hasattr(msg, "id") for msg in new_messages):
-                            truly_new_messages = new_messages
+                        truly_new_messages = _take_unseen_messages(new_messages, seen_message_ids)
                         
                         if truly_new_messages:
-                            # Track message IDs to avoid duplicates
-                            for msg in truly_new_messages:
-                                if hasattr(msg, "id") and msg.id:
-                                    seen_message_ids.add(msg.id)
-                            
                             # Add to accumulated messages
-                            accumulated_messages.extend(truly_new_messages)
+                            accumulated_messages += truly_new_messages
                             
                             # Extract tool calls from new messages
-                            subagent_tool_calls = _extract_subagent_tool_calls(truly_new_messages)
+                            # One pass yields the tool calls and which message types are present
+                            subagent_tool_calls, has_ai_in_batch, has_tool_messages_in_batch = _scan_subagent_messages(
+                                truly_new_messages
+                            )
                             
                             # Update state during streaming so frontend sees tool calls and results in real-time
                             # Stream ALL message types (AIMessages with tool_calls AND ToolMessages with results)
                             # Just like main agent: AIMessage → tool calls appear, ToolMessage → status updates to completed
-                            if subagent_tool_calls or any(isinstance(msg, (AIMessage, ToolMessage)) for msg in truly_new_messages):
+                            if subagent_tool_calls or has_ai_in_batch or has_tool_messages_in_batch:
                                 try:
-                                    # Create messages WITH tool_calls/results for real-time display (via stream_writer)
-                                    # These will appear in stream.messages and show tool calls/results as they happen
-                                    messages_with_tool_calls_for_display = []
-                                    # Create messages WITHOUT tool_calls for main agent's message history
-                                    messages_without_tool_calls_for_history = []
+                                    # Messages for real-time display (via stream_writer); they appear in
+                                    # stream.messages and show tool calls/results as they happen. The main
+                                    # agent's history only gets the final ToolMessage, so no history
+                                    # variants are built here
+                                    pending_tool_messages = []
+                                    ai_messages_only = []
+                                    has_ai_with_tool_calls = False
                                     
-                                    for msg in truly_new_messages:
-                                        if isinstance(msg, AIMessage):
-                                            prepared_msg = _prepare_subagent_ai_message(
-                                                msg,
-                                                parent_tool_call_id=runtime.tool_call_id,
-                                                subagent_type=subagent_type,
-                                            )
-                                            messages_with_tool_calls_for_display.append(prepared_msg)
-                                            messages_without_tool_calls_for_history.append(deepcopy(prepared_msg))
-                                        elif isinstance(msg, ToolMessage):
-                                            # ToolMessages contain results - stream them IMMEDIATELY, one at a time
-                                            # Just like main agent: each ToolMessage is added to state as soon as the tool completes
-                                            # This ensures real-time status updates, not batched at the end
-                                            msg_copy = deepcopy(msg)
-                                            # Add metadata to indicate this is from a sub-agent
-                                            if not hasattr(msg_copy, "additional_kwargs") or msg_copy.additional_kwargs is None:
-                                                msg_copy.additional_kwargs = {}
-                                            msg_copy.additional_kwargs["_subagent_source"] = {
-                                                "tool_call_id": runtime.tool_call_id,
-                                                "subagent_type": subagent_type,
-                                            }
-                                            # Include ToolMessages in both display and history (they don't have tool_calls)
-                                            messages_with_tool_calls_for_display.append(msg_copy)
-                                            messages_without_tool_calls_for_history.append(msg_copy)
+                                    # The copies below only feed stream_writer, so skip them when nothing is streamed
+                                    if stream_writer:
+                                        for msg in truly_new_messages:
+                                            # Exact type checks cover the common case; isinstance only runs for subclasses
+                                            msg_type = type(msg)
+                                            if msg_type is AIMessage or (msg_type is not ToolMessage and isinstance(msg, AIMessage)):
+                                                # CRITICAL: Check if AIMessage has tool_calls (even if not extracted yet)
+                                                # We need to stream immediately when AIMessage with tool_calls arrives, so frontend shows "spinning"
+                                                if not has_ai_with_tool_calls:
+                                                    msg_kwargs = msg.additional_kwargs
+                                                    has_ai_with_tool_calls = bool(msg.tool_calls) or bool(
+                                                        msg_kwargs and ("tool_calls" in msg_kwargs or "_subagent_tool_calls" in msg_kwargs)
+                                                    )
+                                                prepared_msg = _strip_tool_calls_from_message(msg, _subagent_source=subagent_source)
+                                                ai_messages_only.append(prepared_msg)
+                                            elif msg_type is ToolMessage or isinstance(msg, ToolMessage):
+                                                # ToolMessages contain results - stream them as soon as their chunk arrives
+                                                # Just like main agent: each ToolMessage is added to state as soon as the tool completes
+                                                # This ensures real-time status updates, not batched at the end
+                                                # Add metadata to indicate this is from a sub-agent; only
+                                                # additional_kwargs changes, so a shallow copy is enough
+                                                msg_copy = msg.model_copy(update={"additional_kwargs": {
+                                                    **(msg.additional_kwargs or {}),
+                                                    "_subagent_source": subagent_source,
+                                                }})
+                                                # Queued and flushed once per chunk below: a tool node returns all of
+                                                # its results in one update, so this is one write instead of one per tool
+                                                pending_tool_messages.append(msg_copy)
+                                    
+                                    # Stream the ToolMessages of this chunk together with the updated map
+                                    if pending_tool_messages and stream_writer:
+                                        try:
+                                            # Get current map for this tool_call_id
+                                            current_map_for_tool = _with_state_tool_calls_map(accumulated_tool_calls_map, runtime)
+                                            
+                                            # CRITICAL: Update tool call status to "completed" when ToolMessages arrive
+                                            if tool_call_id in current_map_for_tool:
+                                                tool_calls_list = current_map_for_tool[tool_call_id].get("tool_calls", [])
+                                                for tool_msg in pending_tool_messages:
+                                                    tool_call_id_from_msg = getattr(tool_msg, "tool_call_id", None)
+                                                    if not tool_call_id_from_msg:
+                                                        continue
+                                                    # Find the tool call in the map and update its status
+                                                    for tc in tool_calls_list:
+                                                        if tc.get("id") == tool_call_id_from_msg:
+                                                            tc["status"] = "completed"
+                                                            tc["result"] = _message_content(tool_msg)
+                                                            break
                                             
-                                            # Stream this ToolMessage IMMEDIATELY (like main agent does)
-                                            # Don't wait for other messages - stream as soon as tool completes
-                                            # In sync function, no need to yield control - streaming happens synchronously
-                                            if hasattr(runtime, "stream_writer") and runtime.stream_writer:
-                                                try:
-                                                    # Get current map for this tool_call_id
-                                                    # Use a unique context copy to avoid mutating shared state
-                                                    current_map_for_tool = accumulated_tool_calls_map.copy()
-                                                    try:
-                                                        if hasattr(runtime, "state") and runtime.state:
-                                                            state_map = runtime.state.get("subagent_tool_calls_map", {})
-                                                            if isinstance(state_map, dict):
-                                                                for key, value in state_map.items():
-                                                                    if key not in current_map_for_tool:
-                                                                        current_map_for_tool[key] = value
-                                                    except Exception:
-                                                        pass
-                                                    
-                                                    # CRITICAL: Update tool call status to "completed" when ToolMessage arrives
-                                                    # Extract tool_call_id from the ToolMessage
-                                                    tool_call_id_from_msg = getattr(msg_copy, "tool_call_id", None)
-                                                    if tool_call_id_from_msg and runtime.tool_call_id in current_map_for_tool:
-                                                        # Find the tool call in the map and update its status
-                                                        tool_calls_list = current_map_for_tool[runtime.tool_call_id].get("tool_calls", [])
-                                                        for tc in tool_calls_list:
-                                                            if tc.get("id") == tool_call_id_from_msg:
-                                                                tc["status"] = "completed"
-                                                                # Also add the result content
-                                                                if hasattr(msg_copy, "content"):
-                                                                    tc["result"] = msg_copy.content
-                                                                elif hasattr(msg_copy, "text"):
-                                                                    tc["result"] = msg_copy.text
-                                                                break
-                                                    
-                                                    # Update accumulated map so subsequent streams have the updated status
-                                                    accumulated_tool_calls_map = current_map_for_tool.copy()
-                                                    
-                                                    # Stream this single ToolMessage immediately with updated map
-                                                    stream_update_immediate = {
-                                                        "messages": [msg_copy],  # Stream this ONE ToolMessage immediately
-                                                        "subagent_tool_calls_map": current_map_for_tool,  # Map with updated "completed" status
-                                                    }
-                                                    runtime.stream_writer(stream_update_immediate)
-                                                except Exception as e:
-                                                    import logging
-                                                    logging.warning(f"Failed to stream ToolMessage immediately: {e}", exc_info=True)
+                                            # Update accumulated map so subsequent streams have the updated status;
+                                            # the map is copied before its keys change, so no snapshot is needed here
+                                            accumulated_tool_calls_map = current_map_for_tool
+                                            
+                                            stream_writer({
+                                                "messages": pending_tool_messages,
+                                                # This call's entry with the updated "completed" status
+                                                "subagent_tool_calls_map": _streamed_tool_calls_map(current_map_for_tool, tool_call_id),
+                                            })
+                                        except Exception as e:
+                                            _log.warning("Failed to stream ToolMessages: %s", e, exc_info=True)
                                     
                                     # Get current subagent_tool_calls_map from accumulated map and state
-                                    # Use a unique context copy to avoid mutating shared state
-                                    current_map = accumulated_tool_calls_map.copy()
-                                    try:
-                                        if hasattr(runtime, "state") and runtime.state:
-                                            state_map = runtime.state.get("subagent_tool_calls_map", {})
-                                            if isinstance(state_map, dict):
-                                                # Merge state map into current_map
-                                                for key, value in state_map.items():
-                                                    if key not in current_map:
-                                                        current_map[key] = value
-                                    except Exception:
-                                        pass
+                                    current_map = _with_state_tool_calls_map(accumulated_tool_calls_map, runtime)
                                     
                                     # CRITICAL: Initialize map entry if it doesn't exist (needed for streaming)
-                                    if runtime.tool_call_id not in current_map:
-                                        current_map[runtime.tool_call_id] = {
+                                    if tool_call_id not in current_map:
+                                        if current_map is accumulated_tool_calls_map:
+                                            # Copy before adding a key; the accumulated map may already be streamed
+                                            current_map = current_map.copy()
+                                        current_map[tool_call_id] = {
                                             "tool_calls": [],
                                             "subagent_type": subagent_type,
                                         }
@@ -1067,120 +1097,110 @@ def _create_task_tool(
                                     # Merge new tool calls into map
                                     has_new_tool_calls = False
                                     if subagent_tool_calls:
-                                        # Append new tool calls (avoid duplicates by ID)
-                                        existing_ids = {tc.get("id") for tc in current_map[runtime.tool_call_id].get("tool_calls", [])}
-                                        new_tool_calls = [tc for tc in subagent_tool_calls if tc.get("id") not in existing_ids]
+                                        # Append new tool calls (avoid duplicates by ID); the id set grows
+                                        # with the map entry instead of being rebuilt for every chunk
+                                        new_tool_calls = [tc for tc in subagent_tool_calls if tc.get("id") not in known_tool_call_ids]
+                                        known_tool_call_ids.update(tc.get("id") for tc in new_tool_calls)
                                         if new_tool_calls:
                                             has_new_tool_calls = True
                                             # Ensure all new tool calls have status "pending" if no result yet
                                             for tc in new_tool_calls:
                                                 if "status" not in tc:
                                                     tc["status"] = "pending"
-                                            current_map[runtime.tool_call_id]["tool_calls"].extend(new_tool_calls)
+                                            current_map[tool_call_id]["tool_calls"].extend(new_tool_calls)
                                             # Update accumulated map for final state update
-                                            accumulated_tool_calls_map = current_map.copy()
+                                            accumulated_tool_calls_map = current_map
                                     
                                     # CRITICAL FIX: Stream AIMessages immediately when they arrive, even if tool calls aren't extracted yet
                                     # This ensures tool calls appear in the frontend as soon as they're available
-                                    # ToolMessages are already streamed individually above, so we stream AIMessages here
-                                    ai_messages_only = [m for m in messages_with_tool_calls_for_display if isinstance(m, AIMessage)]
+                                    # ToolMessages were already written above, once per chunk, so we stream AIMessages here
+                                    # ai_messages_only and has_ai_with_tool_calls are collected in the loop above
                                     has_ai_messages = len(ai_messages_only) > 0
                                     
-                                    # CRITICAL: Check if AIMessage has tool_calls (even if not extracted yet)
-                                    # We need to stream immediately when AIMessage with tool_calls arrives, so frontend shows "spinning"
-                                    has_ai_with_tool_calls = False
-                                    for msg in truly_new_messages:
-                                        if isinstance(msg, AIMessage):
-                                            if (hasattr(msg, "tool_calls") and msg.tool_calls) or \
-                                               (hasattr(msg, "additional_kwargs") and msg.additional_kwargs and 
-                                                ("tool_calls" in msg.additional_kwargs or "_subagent_tool_calls" in msg.additional_kwargs)):
-                                                has_ai_with_tool_calls = True
-                                                break
-                                    
                                     # CRITICAL: Stream if we have new tool calls OR status updates from ToolMessages
                                     # We MUST stream when ToolMessages update status, even if no new tool calls were added
                                     # This ensures tool calls transition from "pending" (spinning) to "completed" (green checkmark)
                                     should_stream_ai = (
                                         ai_messages_only and 
-                                        hasattr(runtime, "stream_writer") and 
-                                        runtime.stream_writer and
+                                        stream_writer and
                                         (has_new_tool_calls or has_ai_messages or has_ai_with_tool_calls or has_tool_messages_in_batch)
                                     )
                                     
                                     if should_stream_ai:
                                         try:
-                                            # Stream AIMessages with tool_calls (ToolMessages are already streamed individually above)
-                                            # This matches main agent behavior: AIMessage appears first, then ToolMessages appear one by one
+                                            # Stream AIMessages with tool_calls (this chunk's ToolMessages were already written above in one batch)
+                                            # AIMessage appears first, then each tool node's results arrive together in their own write
                                             stream_update = {
-                                                "messages": ai_messages_only,  # Only AIMessages (ToolMessages streamed individually)
-                                                "subagent_tool_calls_map": current_map,  # Also send the map as backup
+                                                "messages": ai_messages_only,  # Only AIMessages (ToolMessages are written once per chunk above)
+                                                # Also send this call's map entry as backup
+                                                "subagent_tool_calls_map": _streamed_tool_calls_map(current_map, tool_call_id),
                                             }
-                                            import logging
-                                            logging.info(
-                                                f"[SubAgent] Streaming AIMessages with tool_calls: tool_call_id={runtime.tool_call_id}, "
-                                                f"ai_messages_count={len(ai_messages_only)}, "
-                                                f"new_tool_calls_count={len(new_tool_calls) if has_new_tool_calls else 0}, "
-                                                f"total_tool_calls_count={len(current_map.get(runtime.tool_call_id, {}).get('tool_calls', []))}"
-                                            )
-                                            runtime.stream_writer(stream_update)
+                                            if _log.isEnabledFor(logging.INFO):
+                                                _log.info(
+                                                    "[SubAgent] Streaming AIMessages with tool_calls: tool_call_id=%s, "
+                                                    "ai_messages_count=%d, new_tool_calls_count=%d, total_tool_calls_count=%d",
+                                                    tool_call_id,
+                                                    len(ai_messages_only),
+                                                    len(new_tool_calls) if has_new_tool_calls else 0,
+                                                    len(current_map.get(tool_call_id, {}).get("tool_calls", [])),
+                                                )
+                                            stream_writer(stream_update)
                                         except Exception as e:
-                                            import logging
-                                            logging.warning(f"Failed to forward sub-agent streaming update: {e}", exc_info=True)
-                                    
-                                    # Store messages WITHOUT tool_calls for final state update (for main agent's history)
-                                    # These will be added to the main thread's message history at the end to avoid OpenAI errors
-                                    if messages_without_tool_calls_for_history:
-                                        # Replace accumulated messages with versions without tool_calls for this tool_call_id
-                                        # This ensures the main agent's history doesn't have incomplete tool call sequences
-                                        pass  # We'll handle this in the final state update
+                                            _log.warning("Failed to forward sub-agent streaming update: %s", e, exc_info=True)
                                 except Exception as e:
-                                    import logging
-                                    logging.error(f"Failed to update state during sub-agent streaming: {e}", exc_info=True)
+                                    _log.error("Failed to update state during sub-agent streaming: %s", e, exc_info=True)
                 
                 # Track final result (merge with accumulated state)
                 if isinstance(state_update, dict):
                     if final_result is None:
                         final_result = state_update.copy()
                     else:
-                        # Merge state updates (messages will be handled separately)
-                        for key, value in state_update.items():
-                            if key != "messages":
-                                final_result[key] = value
-                    
-                    # Update final result with accumulated messages
-                    if accumulated_messages:
-                        final_result["messages"] = accumulated_messages
+                        # Merge state updates in one C-level update; `messages` is replaced by
+                        # accumulated_messages after the loop whenever any were streamed
+                        final_result.update(state_update)
+        
+        # Messages are accumulated across chunks, so they are attached once here
+        if final_result is not None and accumulated_messages:
+            final_result["messages"] = accumulated_messages
         
         # If we didn't get a final result, use the last state update
         if final_result is None:
             # Fallback to invoke if streaming didn't work
             final_result = subagent.invoke(subagent_state, config={"callbacks": callbacks} if callbacks else None)
         
-        # Ensure messages are in final_result
-        if final_result and "messages" not in final_result:
-            if accumulated_messages:
-                final_result["messages"] = accumulated_messages
-            else:
-                # If no accumulated messages, try to get from final_result state
-                import logging
-                logging.warning(
-                    f"[SubAgent] task: No messages in final_result and no accumulated_messages. "
-                    f"final_result keys: {list(final_result.keys()) if isinstance(final_result, dict) else 'not a dict'}"
-                )
+        # Streamed messages were attached above, so a result without any only needs a warning
+        if final_result and "messages" not in final_result and _log.isEnabledFor(logging.WARNING):
+            _log.warning(
+                "[SubAgent] task: No messages in final_result and no accumulated_messages. final_result keys: %s",
+                list(final_result.keys()) if isinstance(final_result, dict) else "not a dict",
+            )
         
-        import logging
-        logging.info(
-            f"[SubAgent] task: Final result has {len(final_result.get('messages', []))} messages, "
-            f"accumulated_messages has {len(accumulated_messages)} messages, "
-            f"subagent_type={subagent_type}, tool_call_id={runtime.tool_call_id}"
+        _log.info(
+            "[SubAgent] task: Final result has %d messages, accumulated_messages has %d messages, "
+            "subagent_type=%s, tool_call_id=%s",
+            len(final_result.get("messages", [])),
+            len(accumulated_messages),
+            subagent_type,
+            tool_call_id,
         )
         
-        return _return_command_with_state_update(final_result, runtime.tool_call_id, subagent_type=subagent_type, accumulated_tool_calls_map=accumulated_tool_calls_map)
+        _cache_messages(subagent_type, description, final_result)
+        return _return_command_with_state_update(final_result, tool_call_id, subagent_type=subagent_type, accumulated_tool_calls_map=accumulated_tool_calls_map)
 
     async def atask(
         description: str,
         subagent_type: str,
         runtime: ToolRuntime,
+    ) -> str | Command:
+        if subagent_semaphore is None:
+            return await _arun_subagent(description, subagent_type, runtime)
+        async with subagent_semaphore:
+            return await _arun_subagent(description, subagent_type, runtime)
+
+    async def _arun_subagent(
+        description: str,
+        subagent_type: str,
+        runtime: ToolRuntime,
     ) -> str | Command:
         subagent, subagent_state = _validate_and_prepare_state(subagent_type, description, runtime)
         # Extract callbacks from runtime config to pass to sub-agent
@@ -1191,6 +1211,11 @@ def _create_task_tool(
             value_error_msg = "Tool call ID is required for subagent invocation"
             raise ValueError(value_error_msg)
         
+        cached_messages = _get_cached_messages(subagent_type, description)
+        if cached_messages is not None:
+            # Only the ToolMessage and this call's tool-calls entry are rebuilt from the transcript
+            return _return_command_with_state_update({"messages": cached_messages}, runtime.tool_call_id, subagent_type=subagent_type)
+        
         # Use astream to get real-time updates from sub-agent
         # Stream with "updates" mode to get state updates as they happen
         final_result = None
@@ -1200,331 +1225,79 @@ def _create_task_tool(
         # Each sub-agent invocation has a unique tool_call_id (runtime.tool_call_id)
         # This map is keyed by tool_call_id, so it only contains tool calls for the current sub-agent
         # When multiple sub-agents run in parallel, each has its own accumulated_tool_calls_map
-        accumulated_tool_calls_map = {}
+        # The parent state does not change while the sub-agent runs, so its map is merged
+        # in once here instead of on every streamed batch
+        accumulated_tool_calls_map = dict(_state_tool_calls_map(runtime))
+        # Ids of the tool calls already in this sub-agent's map entry
+        known_tool_call_ids = {
+            tc.get("id") for tc in accumulated_tool_calls_map.get(runtime.tool_call_id, {}).get("tool_calls", [])
+        }
+        # One `_subagent_source` marker shared by every message this run streams; it is never mutated
+        subagent_source = {"tool_call_id": runtime.tool_call_id, "subagent_type": subagent_type}
+        stream_writer = getattr(runtime, "stream_writer", None)
         
-        # Use both "updates" and "values" modes to get both incremental updates and full state
-        # "updates" gives us state deltas, "values" gives us full state including messages
+        # "updates" yields each node's state delta once, and the messages in it carry
+        # ids, so seen_message_ids is enough to dedup without a full "values" snapshot
         async for chunk in subagent.astream(
-            subagent_state, 
+            subagent_state,
             config={"callbacks": callbacks} if callbacks else None,
-            stream_mode=["updates", "values"]
+            stream_mode="updates",
         ):
-            import logging
-            logging.info(
-                f"[SubAgent] atask: Received chunk type={type(chunk).__name__}, "
-                f"chunk={chunk if not isinstance(chunk, dict) or len(str(chunk)) < 500 else 'dict (too large)'}"
-            )
-            
-            # When using multiple stream modes, chunks come as (stream_mode, chunk) tuples
-            # Handle both single mode (dict) and multiple modes (tuple) formats
-            stream_mode = None
-            chunk_data = None
-            
-            if isinstance(chunk, tuple) and len(chunk) == 2:
-                # Format: (stream_mode, chunk_data)
-                stream_mode, chunk_data = chunk
-            elif isinstance(chunk, dict):
-                # Single mode: chunk is directly the data
-                chunk_data = chunk
-                stream_mode = "updates"  # Default assumption
-            else:
-                logging.warning(f"[SubAgent] atask: Unknown chunk format: type={type(chunk).__name__}, chunk={chunk}")
-                continue
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("[SubAgent] atask: Received chunk type=%s", type(chunk).__name__)
             
-            # chunk_data should be a dict like {node_name: state_update}
-            if not isinstance(chunk_data, dict):
-                logging.warning(f"[SubAgent] atask: chunk_data is not a dict: type={type(chunk_data).__name__}")
+            # With a single stream mode each chunk is a plain {node_name: state_update} dict
+            if not isinstance(chunk, dict):
+                _log.warning("[SubAgent] atask: Unknown chunk format: type=%s, chunk=%r", type(chunk).__name__, chunk)
                 continue
             
-            items_to_process = list(chunk_data.items())
-            
             # Extract messages and tool calls from each update
-            # In "values" mode, we get full state; in "updates" mode, we get state deltas
-            for item in items_to_process:
-                if isinstance(item, tuple) and len(item) == 2:
-                    node_name, state_update = item
-                else:
-                    continue
-                    
-                
-                # Handle both "updates" (state deltas) and "values" (full state) modes
-                # In "values" mode, chunks come as (stream_mode, {node_name: value}) where node_name is the state key
-                # So if node_name is "messages", state_update IS the list of messages
-                # In "updates" mode, state_update is a dict with state deltas
-                if stream_mode == "values" and node_name == "messages":
-                    # In values mode, when node_name is "messages", state_update IS the list of messages
+            for state_update in chunk.values():
+                if isinstance(state_update, dict) and "messages" in state_update:
                     # Handle Overwrite objects that might wrap the messages
-                    messages_raw = state_update
-                    
-                    # Extract actual value if it's wrapped in Overwrite
-                    if isinstance(messages_raw, Overwrite):
-                        new_messages = messages_raw.value if hasattr(messages_raw, "value") else []
-                    elif isinstance(messages_raw, dict) and "__overwrite__" in messages_raw:
-                        # Handle JSON format with __overwrite__ key
-                        new_messages = messages_raw["__overwrite__"]
-                    else:
-                        new_messages = messages_raw if isinstance(messages_raw, list) else []
+                    new_messages = _unwrap_messages(state_update["messages"])
                     
                     if new_messages:
-                        # Filter out messages we've already seen
-                        truly_new_messages = [
-                            msg for msg in new_messages
-                            if hasattr(msg, "id") and msg.id not in seen_message_ids
-                        ]
-                        
-                        # If no IDs, assume all are new
-                        if not any(hasattr(msg, "id") for msg in new_messages):
-                            truly_new_messages = new_messages
+                        # Filter out messages we've already seen, recording their ids in the same pass
+                        truly_new_messages = _take_unseen_messages(new_messages, seen_message_ids)
                         
                         if truly_new_messages:
-                            # Track message IDs
-                            for msg in truly_new_messages:
-                                if hasattr(msg, "id") and msg.id:
-                                    seen_message_ids.add(msg.id)
-                            
-                            # Add to accumulated messages
-                            accumulated_messages.extend(truly_new_messages)
-                            
-                            # Get current subagent_tool_calls_map from accumulated map and state FIRST
-                            # This is needed before we process messages to update their status
-                            current_map = accumulated_tool_calls_map.copy()
-                            try:
-                                if hasattr(runtime, "state") and runtime.state:
-                                    state_map = runtime.state.get("subagent_tool_calls_map", {})
-                                    if isinstance(state_map, dict):
-                                        # Merge state map into current_map
-                                        for key, value in state_map.items():
-                                            if key not in current_map:
-                                                current_map[key] = value
-                            except Exception:
-                                pass
-                            
-                            # CRITICAL: Initialize map entry if it doesn't exist (needed for streaming)
-                            if runtime.tool_call_id not in current_map:
-                                current_map[runtime.tool_call_id] = {
-                                    "tool_calls": [],
-                                    "subagent_type": subagent_type,
-                                }
-                            
-                            # CRITICAL: Extract tool calls from AIMessages ONLY first (to get "pending" status)
-                            # Then we'll update to "completed" when ToolMessages arrive
-                            ai_messages_only = [msg for msg in truly_new_messages if isinstance(msg, AIMessage)]
-                            subagent_tool_calls_from_ai = _extract_subagent_tool_calls(ai_messages_only) if ai_messages_only else []
-                            
-                            # ALWAYS send updates for new messages to enable real-time streaming
-                            # This ensures frontend sees messages as they arrive, not just at the end
-                            try:
-                                messages_with_tool_calls_for_display = []
-                                messages_without_tool_calls_for_history = []
-                                
-                                # Process messages for display
-                                for msg in truly_new_messages:
-                                    if isinstance(msg, AIMessage):
-                                        prepared_msg = _prepare_subagent_ai_message(
-                                            msg,
-                                            parent_tool_call_id=runtime.tool_call_id,
-                                            subagent_type=subagent_type,
-                                        )
-                                        messages_with_tool_calls_for_display.append(prepared_msg)
-                                        messages_without_tool_calls_for_history.append(deepcopy(prepared_msg))
-                                    elif isinstance(msg, ToolMessage):
-                                        # ToolMessages should also be included for real-time display
-                                        msg_copy = deepcopy(msg)
-                                        if not hasattr(msg_copy, "additional_kwargs") or msg_copy.additional_kwargs is None:
-                                            msg_copy.additional_kwargs = {}
-                                        msg_copy.additional_kwargs["_subagent_source"] = {
-                                            "tool_call_id": runtime.tool_call_id,
-                                            "subagent_type": subagent_type,
-                                        }
-                                        messages_with_tool_calls_for_display.append(msg_copy)
-                                        messages_without_tool_calls_for_history.append(msg_copy)
-                                
-                                # CRITICAL: First, add tool calls from AIMessages with "pending" status
-                                # This ensures tool calls show as "spinning" when they first appear
-                                has_new_tool_calls = False
-                                if subagent_tool_calls_from_ai:
-                                    # Append new tool calls (avoid duplicates by ID)
-                                    existing_ids = {tc.get("id") for tc in current_map[runtime.tool_call_id].get("tool_calls", [])}
-                                    new_tool_calls = [tc for tc in subagent_tool_calls_from_ai if tc.get("id") not in existing_ids]
-                                    if new_tool_calls:
-                                        has_new_tool_calls = True
-                                        # Force all new tool calls to "pending" status (they come from AIMessages)
-                                        for tc in new_tool_calls:
-                                            tc["status"] = "pending"
-                                            # Remove result if present (shouldn't be, but just in case)
-                                            tc.pop("result", None)
-                                        current_map[runtime.tool_call_id]["tool_calls"].extend(new_tool_calls)
-                                        # Update accumulated map for final state update
-                                        accumulated_tool_calls_map = current_map.copy()
-                                
-                                # CRITICAL: Then, update status of tool calls to "completed" when ToolMessages arrive
-                                # This ensures tool calls transition from "pending" (spinning) to "completed" (green checkmark)
-                                has_tool_messages = False
-                                status_updated = False
-                                for msg in truly_new_messages:
-                                    if isinstance(msg, ToolMessage):
-                                        has_tool_messages = True
-                                        tool_call_id_from_msg = getattr(msg, "tool_call_id", None)
-                                        if tool_call_id_from_msg and runtime.tool_call_id in current_map:
-                                            tool_calls_list = current_map[runtime.tool_call_id].get("tool_calls", [])
-                                            for tc in tool_calls_list:
-                                                if tc.get("id") == tool_call_id_from_msg:
-                                                    # Only update if status is not already "completed" (avoid unnecessary updates)
-                                                    if tc.get("status") != "completed":
-                                                        tc["status"] = "completed"
-                                                        status_updated = True
-                                                    # Also add the result content
-                                                    if hasattr(msg, "content"):
-                                                        tc["result"] = msg.content
-                                                    elif hasattr(msg, "text"):
-                                                        tc["result"] = msg.text
-                                                    break
-                                
-                                # Update accumulated map after status updates
-                                if has_tool_messages and status_updated:
-                                    accumulated_tool_calls_map = current_map.copy()
-                                
-                                # CRITICAL FIX: ALWAYS stream messages when they arrive, even if tool calls aren't extracted yet
-                                # This ensures AIMessages appear immediately in the frontend, and tool calls appear as soon as they're extracted
-                                # The frontend will show tool calls as "pending" initially, then update to "completed" when ToolMessages arrive
-                                has_ai_messages = any(isinstance(m, AIMessage) for m in messages_with_tool_calls_for_display)
-                                
-                                # CRITICAL: Check if AIMessage has tool_calls (even if not extracted yet)
-                                # We need to stream immediately when AIMessage with tool_calls arrives, so frontend shows "spinning"
-                                has_ai_with_tool_calls = False
-                                for msg in truly_new_messages:
-                                    if isinstance(msg, AIMessage):
-                                        if (hasattr(msg, "tool_calls") and msg.tool_calls) or \
-                                           (hasattr(msg, "additional_kwargs") and msg.additional_kwargs and 
-                                            ("tool_calls" in msg.additional_kwargs or "_subagent_tool_calls" in msg.additional_kwargs)):
-                                            has_ai_with_tool_calls = True
-                                            break
-                                
-                                # CRITICAL: Stream if we have new tool calls OR status updates from ToolMessages
-                                # We MUST stream when ToolMessages update status, even if no new tool calls were added
-                                # This ensures tool calls transition from "pending" (spinning) to "completed" (green checkmark)
-                                # status_updated indicates that tool call statuses were changed to "completed"
-                                should_stream = (
-                                    messages_with_tool_calls_for_display and 
-                                    hasattr(runtime, "stream_writer") and 
-                                    runtime.stream_writer and
-                                    (has_new_tool_calls or has_tool_messages or has_ai_messages or has_ai_with_tool_calls or status_updated)
-                                )
-                                
-                                if should_stream:
-                                    try:
-                                        # Add messages WITH tool_calls/results to the messages state for real-time display
-                                        # These will appear in stream.messages and the frontend will:
-                                        # 1. Extract tool calls from AIMessages (status: "pending") - shows as spinning
-                                        # 2. Update tool call status when ToolMessages arrive (status: "completed") - shows as green checkmark
-                                        # CRITICAL: Always include the updated map, even if only status changed (not new tool calls)
-                                        stream_update = {
-                                            "messages": messages_with_tool_calls_for_display,  # Messages WITH tool_calls/results for real-time display
-                                            "subagent_tool_calls_map": current_map,  # Map with updated statuses (pending → completed)
-                                        }
-                                        import logging
-                                        logging.info(
-                                            f"[SubAgent] atask: Streaming messages (AIMessages + ToolMessages) from values mode: "
-                                            f"tool_call_id={runtime.tool_call_id}, "
-                                            f"messages_count={len(messages_with_tool_calls_for_display)}, "
-                                            f"ai_messages={sum(1 for m in messages_with_tool_calls_for_display if isinstance(m, AIMessage))}, "
-                                            f"tool_messages={sum(1 for m in messages_with_tool_calls_for_display if isinstance(m, ToolMessage))}, "
-                                            f"has_tool_messages={has_tool_messages}, "
-                                            f"new_tool_calls_count={len(new_tool_calls) if has_new_tool_calls else 0}, "
-                                            f"total_tool_calls_count={len(current_map.get(runtime.tool_call_id, {}).get('tool_calls', []))}"
-                                        )
-                                        runtime.stream_writer(stream_update)
-                                    except Exception as e:
-                                        import logging
-                                        logging.warning(f"Failed to forward sub-agent streaming update: {e}", exc_info=True)
-                                
-                                # Store messages WITHOUT tool_calls for final state update (for main agent's history)
-                                # These will be added to the main thread's message history at the end to avoid OpenAI errors
-                                if messages_without_tool_calls_for_history:
-                                    # Replace accumulated messages with versions without tool_calls for this tool_call_id
-                                    # This ensures the main agent's history doesn't have incomplete tool call sequences
-                                    pass  # We'll handle this in the final state update
-                            except Exception as e:
-                                import logging
-                                logging.error(f"Failed to update state during sub-agent streaming: {e}", exc_info=True)
-                    
-                    # Handle "updates" mode (state deltas)
-                    elif stream_mode == "updates" and isinstance(state_update, dict) and "messages" in state_update:
-                    # Get new messages from this update
-                    # Note: state_update["messages"] might be the full list or just new messages
-                    # We need to track which messages we've already seen
-                        # Handle Overwrite objects that might wrap the messages
-                        messages_raw = state_update.get("messages", [])
-                        
-                        # Extract actual value if it's wrapped in Overwrite
-                        if isinstance(messages_raw, Overwrite):
-                            new_messages = messages_raw.value if hasattr(messages_raw, "value") else []
-                        elif isinstance(messages_raw, dict) and "__overwrite__" in messages_raw:
-                            # Handle JSON format with __overwrite__ key
-                            new_messages = messages_raw["__overwrite__"]
-                        else:
-                            new_messages = messages_raw if isinstance(messages_raw, list) else []
-                        
-                    if new_messages:
-                        # Filter out messages we've already seen (to avoid duplicates)
-                        truly_new_messages = [
-                            msg for msg in new_messages
-                            if hasattr(msg, "id") and msg.id not in seen_message_ids
-                        ]
-                        
-                        # If no IDs, assume all are new (for backwards compatibility)
-                        if not any(hasattr(msg, "id") for msg in new_messages):
-                            truly_new_messages = new_messages
-                        
-                        if truly_new_messages:
-                            # Track message IDs to avoid duplicates
-                            for msg in truly_new_messages:
-                                if hasattr(msg, "id") and msg.id:
-                                    seen_message_ids.add(msg.id)
-                            
                             # Add to accumulated messages
                             accumulated_messages.extend(truly_new_messages)
                             
-                            # Get current subagent_tool_calls_map from accumulated map and state FIRST
-                            current_map = accumulated_tool_calls_map.copy()
-                            try:
-                                if hasattr(runtime, "state") and runtime.state:
-                                    state_map = runtime.state.get("subagent_tool_calls_map", {})
-                                    if isinstance(state_map, dict):
-                                        # Merge state map into current_map
-                                        for key, value in state_map.items():
-                                            if key not in current_map:
-                                                current_map[key] = value
-                            except Exception:
-                                pass
-                            
+                            # The map is owned by this coroutine (the parent state map was merged into a
+                            # fresh dict above), so it is updated in place instead of copied per batch
                             # CRITICAL: Initialize map entry if it doesn't exist (needed for streaming)
-                            if runtime.tool_call_id not in current_map:
-                                current_map[runtime.tool_call_id] = {
+                            if runtime.tool_call_id not in accumulated_tool_calls_map:
+                                accumulated_tool_calls_map[runtime.tool_call_id] = {
                                     "tool_calls": [],
                                     "subagent_type": subagent_type,
                                 }
                             
-                            # CRITICAL: Extract tool calls from AIMessages ONLY first (to get "pending" status)
-                            # Then we'll update to "completed" when ToolMessages arrive
-                            ai_messages_only = [msg for msg in truly_new_messages if isinstance(msg, AIMessage)]
-                            subagent_tool_calls_from_ai = _extract_subagent_tool_calls(ai_messages_only) if ai_messages_only else []
+                            # CRITICAL: Extract tool calls from AIMessages first (they are forced to "pending" below)
+                            # Then we'll update to "completed" when ToolMessages arrive; the same pass
+                            # reports which message types the batch holds
+                            subagent_tool_calls_from_ai, has_ai_in_batch, has_tool_messages_in_batch = _scan_subagent_messages(
+                                truly_new_messages
+                            )
                             
                             # Update state during streaming so frontend sees tool calls and results in real-time
                             # Stream ALL message types (AIMessages with tool_calls AND ToolMessages with results)
                             # Just like main agent: AIMessage → tool calls appear, ToolMessage → status updates to completed
-                            if subagent_tool_calls_from_ai or any(isinstance(msg, (AIMessage, ToolMessage)) for msg in truly_new_messages):
+                            if subagent_tool_calls_from_ai or has_ai_in_batch or has_tool_messages_in_batch:
                                 try:
-                                    messages_with_tool_calls_for_display = []
-                                    messages_without_tool_calls_for_history = []
+                                    pending_tool_messages = []
+                                    ai_messages_only = []
+                                    has_ai_with_tool_calls = False
                                     
                                     # CRITICAL: First, add tool calls from AIMessages with "pending" status
                                     # This ensures tool calls show as "spinning" when they first appear
                                     has_new_tool_calls = False
                                     if subagent_tool_calls_from_ai:
-                                        # Append new tool calls (avoid duplicates by ID)
-                                        existing_ids = {tc.get("id") for tc in current_map[runtime.tool_call_id].get("tool_calls", [])}
-                                        new_tool_calls = [tc for tc in subagent_tool_calls_from_ai if tc.get("id") not in existing_ids]
+                                        # Append new tool calls (avoid duplicates by ID); the id set grows
+                                        # with the map entry instead of being rebuilt for every chunk
+                                        new_tool_calls = [tc for tc in subagent_tool_calls_from_ai if tc.get("id") not in known_tool_call_ids]
+                                        known_tool_call_ids.update(tc.get("id") for tc in new_tool_calls)
                                         if new_tool_calls:
                                             has_new_tool_calls = True
                                             # Force all new tool calls to "pending" status (they come from AIMessages)
@@ -1532,216 +1305,139 @@ def _create_task_tool(
                                                 tc["status"] = "pending"
                                                 # Remove result if present (shouldn't be, but just in case)
                                                 tc.pop("result", None)
-                                            current_map[runtime.tool_call_id]["tool_calls"].extend(new_tool_calls)
-                                            # Update accumulated map for final state update
-                                            accumulated_tool_calls_map = current_map.copy()
+                                            accumulated_tool_calls_map[runtime.tool_call_id]["tool_calls"].extend(new_tool_calls)
                                     
-                                    for msg in truly_new_messages:
-                                        if isinstance(msg, AIMessage):
-                                            prepared_msg = _prepare_subagent_ai_message(
-                                                msg,
-                                                parent_tool_call_id=runtime.tool_call_id,
-                                                subagent_type=subagent_type,
-                                            )
-                                            messages_with_tool_calls_for_display.append(prepared_msg)
-                                            messages_without_tool_calls_for_history.append(deepcopy(prepared_msg))
-                                        elif isinstance(msg, ToolMessage):
-                                            # ToolMessages contain results - stream them IMMEDIATELY, one at a time
-                                            # Just like main agent: each ToolMessage is added to state as soon as the tool completes
-                                            # This ensures real-time status updates, not batched at the end
-                                            msg_copy = deepcopy(msg)
-                                            # Add metadata to indicate this is from a sub-agent
-                                            if not hasattr(msg_copy, "additional_kwargs") or msg_copy.additional_kwargs is None:
-                                                msg_copy.additional_kwargs = {}
-                                            msg_copy.additional_kwargs["_subagent_source"] = {
-                                                "tool_call_id": runtime.tool_call_id,
-                                                "subagent_type": subagent_type,
-                                            }
-                                            # Include ToolMessages in both display and history (they don't have tool_calls)
-                                            messages_with_tool_calls_for_display.append(msg_copy)
-                                            messages_without_tool_calls_for_history.append(msg_copy)
-                                            
-                                            # Stream this ToolMessage IMMEDIATELY (like main agent does)
-                                            # Don't wait for other messages - stream as soon as tool completes
-                                            # Use asyncio.sleep(0) to yield control and ensure each ToolMessage is processed separately
-                                            if hasattr(runtime, "stream_writer") and runtime.stream_writer:
-                                                try:
-                                                    # Get current map for this tool_call_id
-                                                    current_map_for_tool = accumulated_tool_calls_map.copy()
-                                                    try:
-                                                        if hasattr(runtime, "state") and runtime.state:
-                                                            state_map = runtime.state.get("subagent_tool_calls_map", {})
-                                                            if isinstance(state_map, dict):
-                                                                for key, value in state_map.items():
-                                                                    if key not in current_map_for_tool:
-                                                                        current_map_for_tool[key] = value
-                                                    except Exception:
-                                                        pass
-                                                    
-                                                    # CRITICAL: Update tool call status to "completed" when ToolMessage arrives
-                                                    # Extract tool_call_id from the ToolMessage
-                                                    tool_call_id_from_msg = getattr(msg_copy, "tool_call_id", None)
-                                                    if tool_call_id_from_msg and runtime.tool_call_id in current_map_for_tool:
-                                                        # Find the tool call in the map and update its status
-                                                        tool_calls_list = current_map_for_tool[runtime.tool_call_id].get("tool_calls", [])
-                                                        for tc in tool_calls_list:
-                                                            if tc.get("id") == tool_call_id_from_msg:
-                                                                tc["status"] = "completed"
-                                                                # Also add the result content
-                                                                if hasattr(msg_copy, "content"):
-                                                                    tc["result"] = msg_copy.content
-                                                                elif hasattr(msg_copy, "text"):
-                                                                    tc["result"] = msg_copy.text
-                                                                break
-                                                    
-                                                    # Update accumulated map so subsequent streams have the updated status
-                                                    accumulated_tool_calls_map = current_map_for_tool.copy()
-                                                    
-                                                    # Stream this single ToolMessage immediately with updated map
-                                                    stream_update_immediate = {
-                                                        "messages": [msg_copy],  # Stream this ONE ToolMessage immediately
-                                                        "subagent_tool_calls_map": current_map_for_tool,  # Map with updated "completed" status
-                                                    }
-                                                    runtime.stream_writer(stream_update_immediate)
-                                                    
-                                                    # Yield control to ensure this ToolMessage is processed before the next one
-                                                    # This ensures real-time streaming like the main agent
-                                                    import asyncio
-                                                    await asyncio.sleep(0)
-                                                except Exception as e:
-                                                    import logging
-                                                    logging.warning(f"Failed to stream ToolMessage immediately: {e}", exc_info=True)
+                                    # The copies below only feed stream_writer, so skip them when nothing is streamed
+                                    if stream_writer:
+                                        for msg in truly_new_messages:
+                                            # Exact type checks cover the common case; isinstance only runs for subclasses
+                                            msg_type = type(msg)
+                                            if msg_type is AIMessage or (msg_type is not ToolMessage and isinstance(msg, AIMessage)):
+                                                # CRITICAL: Check if AIMessage has tool_calls (even if not extracted yet)
+                                                # We need to stream immediately when AIMessage with tool_calls arrives, so frontend shows "spinning"
+                                                if not has_ai_with_tool_calls:
+                                                    msg_kwargs = msg.additional_kwargs
+                                                    has_ai_with_tool_calls = bool(msg.tool_calls) or bool(
+                                                        msg_kwargs and ("tool_calls" in msg_kwargs or "_subagent_tool_calls" in msg_kwargs)
+                                                    )
+                                                prepared_msg = _strip_tool_calls_from_message(msg, _subagent_source=subagent_source)
+                                                ai_messages_only.append(prepared_msg)
+                                            elif msg_type is ToolMessage or isinstance(msg, ToolMessage):
+                                                # ToolMessages contain results - stream them as soon as their chunk arrives
+                                                # Just like main agent: each ToolMessage is added to state as soon as the tool completes
+                                                # This ensures real-time status updates, not batched at the end
+                                                # Add metadata to indicate this is from a sub-agent; only
+                                                # additional_kwargs changes, so a shallow copy is enough
+                                                msg_copy = msg.model_copy(update={"additional_kwargs": {
+                                                    **(msg.additional_kwargs or {}),
+                                                    "_subagent_source": subagent_source,
+                                                }})
+                                                # Queued and flushed once per chunk below: a tool node returns all of
+                                                # its results in one update, so this is one write instead of one per tool
+                                                pending_tool_messages.append(msg_copy)
                                     
-                                    # CRITICAL: Update status of existing tool calls when ToolMessages arrive in batch
-                                    # This ensures tool calls transition from "pending" to "completed"
-                                    has_tool_messages_in_batch = False
-                                    for msg in truly_new_messages:
-                                        if isinstance(msg, ToolMessage):
-                                            has_tool_messages_in_batch = True
+                                    # CRITICAL: Update tool call status to "completed" when ToolMessages arrive;
+                                    # done with or without a stream writer so the final map has the statuses too
+                                    if has_tool_messages_in_batch and runtime.tool_call_id in accumulated_tool_calls_map:
+                                        tool_calls_list = accumulated_tool_calls_map[runtime.tool_call_id].get("tool_calls", [])
+                                        for msg in truly_new_messages:
+                                            if not (type(msg) is ToolMessage or isinstance(msg, ToolMessage)):
+                                                continue
                                             tool_call_id_from_msg = getattr(msg, "tool_call_id", None)
-                                            if tool_call_id_from_msg and runtime.tool_call_id in current_map:
-                                                tool_calls_list = current_map[runtime.tool_call_id].get("tool_calls", [])
-                                                for tc in tool_calls_list:
-                                                    if tc.get("id") == tool_call_id_from_msg:
-                                                        tc["status"] = "completed"
-                                                        # Also add the result content
-                                                        if hasattr(msg, "content"):
-                                                            tc["result"] = msg.content
-                                                        elif hasattr(msg, "text"):
-                                                            tc["result"] = msg.text
-                                                        break
-                                    
-                                    # Update accumulated map after status updates
-                                    if has_tool_messages_in_batch:
-                                        accumulated_tool_calls_map = current_map.copy()
+                                            if not tool_call_id_from_msg:
+                                                continue
+                                            # Find the tool call in the map and update its status
+                                            for tc in tool_calls_list:
+                                                if tc.get("id") == tool_call_id_from_msg:
+                                                    tc["status"] = "completed"
+                                                    tc["result"] = _message_content(msg)
+                                                    break
                                     
-                                    # CRITICAL: Add tool calls from AIMessages with "pending" status (if not already added)
-                                    # This ensures tool calls show as "spinning" when they first appear
-                                    has_new_tool_calls = False
-                                    if subagent_tool_calls_from_ai:
-                                        # Append new tool calls (avoid duplicates by ID)
-                                        existing_ids = {tc.get("id") for tc in current_map[runtime.tool_call_id].get("tool_calls", [])}
-                                        new_tool_calls = [tc for tc in subagent_tool_calls_from_ai if tc.get("id") not in existing_ids]
-                                        if new_tool_calls:
-                                            has_new_tool_calls = True
-                                            # Force all new tool calls to "pending" status (they come from AIMessages)
-                                            for tc in new_tool_calls:
-                                                tc["status"] = "pending"
-                                                # Remove result if present (shouldn't be, but just in case)
-                                                tc.pop("result", None)
-                                            current_map[runtime.tool_call_id]["tool_calls"].extend(new_tool_calls)
-                                            # Update accumulated map for final state update
-                                            accumulated_tool_calls_map = current_map.copy()
+                                    # Stream the ToolMessages of this chunk together with the updated map
+                                    if pending_tool_messages and stream_writer:
+                                        try:
+                                            stream_writer({
+                                                "messages": pending_tool_messages,
+                                                # This call's entry with the updated "completed" status
+                                                "subagent_tool_calls_map": _streamed_tool_calls_map(
+                                                    accumulated_tool_calls_map, runtime.tool_call_id
+                                                ),
+                                            })
+                                            
+                                            # Yield control once per chunk so the update is forwarded before the
+                                            # sub-agent continues
+                                            await asyncio.sleep(0)
+                                        except Exception as e:
+                                            _log.warning("Failed to stream ToolMessages: %s", e, exc_info=True)
                                     
                                     # CRITICAL FIX: Stream AIMessages immediately when they arrive, even if tool calls aren't extracted yet
                                     # This ensures tool calls appear in the frontend as soon as they're available
-                                    # ToolMessages are already streamed individually above, so we stream AIMessages here
-                                    ai_messages_only = [m for m in messages_with_tool_calls_for_display if isinstance(m, AIMessage)]
+                                    # ToolMessages were already written above, once per chunk, so we stream AIMessages here
+                                    # ai_messages_only and has_ai_with_tool_calls are collected in the loop above
                                     has_ai_messages = len(ai_messages_only) > 0
                                     
-                                    # CRITICAL: Check if AIMessage has tool_calls (even if not extracted yet)
-                                    # We need to stream immediately when AIMessage with tool_calls arrives, so frontend shows "spinning"
-                                    has_ai_with_tool_calls = False
-                                    for msg in truly_new_messages:
-                                        if isinstance(msg, AIMessage):
-                                            if (hasattr(msg, "tool_calls") and msg.tool_calls) or \
-                                               (hasattr(msg, "additional_kwargs") and msg.additional_kwargs and 
-                                                ("tool_calls" in msg.additional_kwargs or "_subagent_tool_calls" in msg.additional_kwargs)):
-                                                has_ai_with_tool_calls = True
-                                                break
-                                    
                                     # CRITICAL: Stream if we have new tool calls OR status updates from ToolMessages
                                     # We MUST stream when ToolMessages update status, even if no new tool calls were added
                                     # This ensures tool calls transition from "pending" (spinning) to "completed" (green checkmark)
                                     should_stream_ai = (
                                         ai_messages_only and 
-                                        hasattr(runtime, "stream_writer") and 
-                                        runtime.stream_writer and
+                                        stream_writer and
                                         (has_new_tool_calls or has_ai_messages or has_ai_with_tool_calls or has_tool_messages_in_batch)
                                     )
                                     
                                     if should_stream_ai:
                                         try:
-                                            # Stream AIMessages with tool_calls (ToolMessages are already streamed individually above)
-                                            # This matches main agent behavior: AIMessage appears first, then ToolMessages appear one by one
+                                            # Stream AIMessages with tool_calls (this chunk's ToolMessages were already written above in one batch)
+                                            # AIMessage appears first, then each tool node's results arrive together in their own write
                                             stream_update = {
-                                                "messages": ai_messages_only,  # Only AIMessages (ToolMessages streamed individually)
-                                                "subagent_tool_calls_map": current_map,  # Also send the map as backup
+                                                "messages": ai_messages_only,  # Only AIMessages (ToolMessages are written once per chunk above)
+                                                # Also send this call's map entry as backup
+                                                "subagent_tool_calls_map": _streamed_tool_calls_map(
+                                                    accumulated_tool_calls_map, runtime.tool_call_id
+                                                ),
                                             }
-                                            import logging
-                                            logging.info(
-                                                f"[SubAgent] Streaming AIMessages with tool_calls: tool_call_id={runtime.tool_call_id}, "
-                                                f"ai_messages_count={len(ai_messages_only)}, "
-                                                f"new_tool_calls_count={len(new_tool_calls) if has_new_tool_calls else 0}, "
-                                                f"total_tool_calls_count={len(current_map.get(runtime.tool_call_id, {}).get('tool_calls', []))}"
-                                            )
-                                            runtime.stream_writer(stream_update)
+                                            if _log.isEnabledFor(logging.INFO):
+                                                _log.info(
+                                                    "[SubAgent] Streaming AIMessages with tool_calls: tool_call_id=%s, "
+                                                    "ai_messages_count=%d, new_tool_calls_count=%d, total_tool_calls_count=%d",
+                                                    runtime.tool_call_id,
+                                                    len(ai_messages_only),
+                                                    len(new_tool_calls) if has_new_tool_calls else 0,
+                                                    len(accumulated_tool_calls_map.get(runtime.tool_call_id, {}).get("tool_calls", [])),
+                                                )
+                                            stream_writer(stream_update)
                                         except Exception as e:
-                                            import logging
-                                            logging.warning(f"Failed to forward sub-agent streaming update: {e}", exc_info=True)
-                                    
-                                    # Store messages WITHOUT tool_calls for final state update (for main agent's history)
-                                    # These will be added to the main thread's message history at the end to avoid OpenAI errors
-                                    if messages_without_tool_calls_for_history:
-                                        # Replace accumulated messages with versions without tool_calls for this tool_call_id
-                                        # This ensures the main agent's history doesn't have incomplete tool call sequences
-                                        pass  # We'll handle this in the final state update
+                                            _log.warning("Failed to forward sub-agent streaming update: %s", e, exc_info=True)
                                 except Exception as e:
-                                    import logging
-                                    logging.error(f"Failed to update state during sub-agent streaming: {e}", exc_info=True)
+                                    _log.error("Failed to update state during sub-agent streaming: %s", e, exc_info=True)
                 
                 # Track final result (merge with accumulated state)
                 if isinstance(state_update, dict):
                     if final_result is None:
                         final_result = state_update.copy()
                     else:
-                        # Merge state updates (messages will be handled separately)
-                        for key, value in state_update.items():
-                            if key != "messages":
-                                final_result[key] = value
-                    
-                    # Update final result with accumulated messages
-                    if accumulated_messages:
-                        final_result["messages"] = accumulated_messages
+                        # Merge state updates in one C-level update; `messages` is replaced by
+                        # accumulated_messages after the loop whenever any were streamed
+                        final_result.update(state_update)
+        
+        # Messages are accumulated across chunks, so they are attached once here
+        if final_result is not None and accumulated_messages:
+            final_result["messages"] = accumulated_messages
         
         # If we didn't get a final result, use the last state update
         if final_result is None:
             # Fallback to ainvoke if streaming didn't work
             final_result = await subagent.ainvoke(subagent_state, config={"callbacks": callbacks} if callbacks else None)
         
-        # Ensure messages are in final_result
-        if final_result and "messages" not in final_result:
-            if accumulated_messages:
-                final_result["messages"] = accumulated_messages
-            else:
-                # If no accumulated messages, try to get from final_result state
-                import logging
-                logging.warning(
-                    f"[SubAgent] atask: No messages in final_result and no accumulated_messages. "
-                    f"final_result keys: {list(final_result.keys()) if isinstance(final_result, dict) else 'not a dict'}"
-                )
+        # Streamed messages were attached above, so a result without any only needs a warning
+        if final_result and "messages" not in final_result and _log.isEnabledFor(logging.WARNING):
+            _log.warning(
+                "[SubAgent] atask: No messages in final_result and no accumulated_messages. final_result keys: %s",
+                list(final_result.keys()) if isinstance(final_result, dict) else "not a dict",
+            )
         
         
+        _cache_messages(subagent_type, description, final_result)
         return _return_command_with_state_update(final_result, runtime.tool_call_id, subagent_type=subagent_type, accumulated_tool_calls_map=accumulated_tool_calls_map)
 
     return StructuredTool.from_function(
@@ -1782,6 +1478,8 @@ class SubAgentMiddleware(AgentMiddleware):
         general_purpose_agent: Whether to include the general-purpose agent. Defaults to `True`.
         task_description: Custom description for the task tool. If `None`, uses the
             default description template.
+        max_concurrent_subagents: Maximum number of subagents allowed to run at the same
+            time. If `None` (default), no limit.
 
     Example:
         ```python
@@ -1824,10 +1522,12 @@ class SubAgentMiddleware(AgentMiddleware):
         system_prompt: str | None = TASK_SYSTEM_PROMPT,
         general_purpose_agent: bool = True,
         task_description: str | None = None,
+        max_concurrent_subagents: int | None = None,
     ) -> None:
         """Initialize the SubAgentMiddleware."""
         super().__init__()
         self.system_prompt = system_prompt
+        self._combined_prompt_cache: dict[str, str] = {}
         task_tool = _create_task_tool(
             default_model=default_model,
             default_tools=default_tools or [],
@@ -1836,6 +1536,7 @@ class SubAgentMiddleware(AgentMiddleware):
             subagents=subagents or [],
             general_purpose_agent=general_purpose_agent,
             task_description=task_description,
+            max_concurrent_subagents=max_concurrent_subagents,
         )
         self.tools = [task_tool]
 
@@ -1846,7 +1547,7 @@ class SubAgentMiddleware(AgentMiddleware):
     ) -> ModelResponse:
         """Update the system prompt to include instructions on using subagents."""
         if self.system_prompt is not None:
-            request.system_prompt = request.system_prompt + "\n\n" + self.system_prompt if request.system_prompt else self.system_prompt
+            request.system_prompt = append_system_prompt(self._combined_prompt_cache, request.system_prompt, self.system_prompt)
         return handler(request)
 
     async def awrap_model_call(
@@ -1856,5 +1557,5 @@ class SubAgentMiddleware(AgentMiddleware):
     ) -> ModelResponse:
         """(async) Update the system prompt to include instructions on using subagents."""
         if self.system_prompt is not None:
-            request.system_prompt = request.system_prompt + "\n\n" + self.system_prompt if request.system_prompt else self.system_prompt
+            request.system_prompt = append_system_prompt(self._combined_prompt_cache, request.system_prompt, self.system_prompt)
         return await handler(request)
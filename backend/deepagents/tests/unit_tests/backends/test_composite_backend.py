@@ -386,3 +386,16 @@ def test_composite_backend_intercept_large_tool_result_routed_to_store():
     stored_item = rt.store.get(("filesystem",), "/test_routed_123")
     assert stored_item is not None
     assert stored_item.value["content"] == [large_content]
+
+
+def test_composite_backend_read_many_routes_paths():
+    rt = make_runtime("t_read_many")
+    be = build_composite_state_backend(rt, routes={"/memories/": (lambda r: StoreBackend(r))})
+
+    be.write("/file.txt", "alpha")
+    be.write("/memories/notes.md", "beta")
+
+    contents = be.read_many(["/file.txt", "/memories/notes.md"])
+    assert set(contents) == {"/file.txt", "/memories/notes.md"}
+    assert "alpha" in contents["/file.txt"]
+    assert "beta" in contents["/memories/notes.md"]
@@ -157,3 +157,29 @@ def test_state_backend_intercept_large_tool_result():
     assert "/large_tool_results/test_123" in result.update["files"]
     assert result.update["files"]["/large_tool_results/test_123"]["content"] == [large_content]
     assert "Tool result too large" in result.update["messages"][0].content
+
+
+def test_state_backend_read_many():
+    rt = make_runtime()
+    be = StateBackend(rt)
+    for path, text in (("/a.md", "alpha"), ("/b.md", "beta")):
+        res = be.write(path, text)
+        rt.state["files"].update(res.files_update)
+
+    contents = be.read_many(["/a.md", "/b.md", "/missing.md"])
+    assert contents["/a.md"] == be.read("/a.md")
+    assert "beta" in contents["/b.md"]
+    assert "not found" in contents["/missing.md"]
+
+
+def test_state_backend_read_and_ls_leave_file_data_unchanged():
+    rt = make_runtime()
+    be = StateBackend(rt)
+    rt.state["files"].update(be.write("/x.txt", "line one\nline two").files_update)
+    before = dict(rt.state["files"]["/x.txt"])
+
+    assert "line two" in be.read("/x.txt")
+    infos = be.ls_info("/")
+
+    assert rt.state["files"]["/x.txt"] == before
+    assert [info["size"] for info in infos if info["path"] == "/x.txt"] == [len("line one\nline two")]
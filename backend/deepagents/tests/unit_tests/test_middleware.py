@@ -1,3 +1,4 @@
+import pytest
 from langchain.agents import create_agent
 from langchain.tools import ToolRuntime
 from langchain_core.messages import (
@@ -14,7 +15,7 @@ from deepagents.backends import CompositeBackend, StateBackend, StoreBackend
 from deepagents.backends.utils import create_file_data, truncate_if_too_long, update_file_data
 from deepagents.middleware.filesystem import FILESYSTEM_SYSTEM_PROMPT, FileData, FilesystemMiddleware, FilesystemState
 from deepagents.middleware.patch_tool_calls import PatchToolCallsMiddleware
-from deepagents.middleware.subagents import SubAgentMiddleware
+from deepagents.middleware.subagents import SubAgentMiddleware, _get_subagents, clear_subagent_cache
 
 
 def build_composite_state_backend(runtime: ToolRuntime, *, routes):
@@ -46,6 +47,35 @@ class TestAddMiddleware:
         agent = create_agent(model="claude-sonnet-4-20250514", middleware=middleware, tools=[])
         assert "task" in agent.nodes["tools"].bound._tools_by_name.keys()
 
+    def test_subagent_graphs_are_memoized(self):
+        clear_subagent_cache()
+        kwargs = {
+            "default_model": "claude-sonnet-4-20250514",
+            "default_tools": [],
+            "default_middleware": None,
+            "default_interrupt_on": None,
+            "subagents": [],
+            "general_purpose_agent": True,
+        }
+        first, _ = _get_subagents(**kwargs)
+        second, _ = _get_subagents(**kwargs)
+        assert first["general-purpose"] is second["general-purpose"]
+        clear_subagent_cache()
+        third, _ = _get_subagents(**kwargs)
+        assert third["general-purpose"] is not first["general-purpose"]
+
+    def test_append_system_prompt_cache_is_bounded(self):
+        from deepagents.middleware._utils import _COMBINED_PROMPT_CACHE_SIZE, append_system_prompt
+
+        cache: dict[str, str] = {}
+        assert append_system_prompt(cache, None, "extra") == "extra"
+        assert append_system_prompt(cache, "base", "extra") == "base\n\nextra"
+        assert append_system_prompt(cache, "base", "extra") is cache["base"]
+        for i in range(_COMBINED_PROMPT_CACHE_SIZE):
+            append_system_prompt(cache, f"base {i}", "extra")
+        assert len(cache) == _COMBINED_PROMPT_CACHE_SIZE
+        assert "base" not in cache
+
     def test_multiple_middleware(self):
         middleware = [FilesystemMiddleware(), SubAgentMiddleware(default_tools=[], subagents=[], default_model="claude-sonnet-4-20250514")]
         agent = create_agent(model="claude-sonnet-4-20250514", middleware=middleware, tools=[])
@@ -816,6 +846,89 @@ class TestFilesystemMiddleware:
         assert lines[1].count("m") == 2000
         assert "     4\tline4" in lines[2]
 
+    def test_head_lines_matches_splitlines(self):
+        """Test that the eviction preview splits lines like str.splitlines, including CRLF."""
+        from deepagents.middleware.filesystem import _head_lines
+
+        for text in ["a\r\nb", "a\rb\n", "\n\nx", "a\r\r\n", "", "one\ntwo\nthree"]:
+            assert _head_lines(text, 10) == text.splitlines()
+        assert _head_lines("a\r\nb\r\nc", 2) == ["a", "b"]
+
+    def test_strip_line_numbers(self):
+        """Test that only well-formed line-number prefixes are removed."""
+        from deepagents.middleware.filesystem import _strip_line_numbers
+
+        content = "     1\tfirst\n   1.1\tcontinued\n\n     3\t\tindented\nno prefix\n 1.\tbad marker\nx1\tbad number"
+        assert _strip_line_numbers(content) == "first\ncontinued\n\n\tindented\nno prefix\n 1.\tbad marker\nx1\tbad number"
+
+    def test_aggregate_document_strips_line_numbers(self):
+        """Test that aggregate_document concatenates sections without backend line-number prefixes."""
+        state = FilesystemState(
+            messages=[],
+            files={
+                "/section_2.md": FileData(content=["Second body"], created_at="2021-01-01", modified_at="2021-01-01"),
+                "/section_1.md": FileData(content=["First line", "", "  indented"], created_at="2021-01-01", modified_at="2021-01-01"),
+            },
+        )
+        middleware = FilesystemMiddleware()
+        aggregate_tool = next(tool for tool in middleware.tools if tool.name == "aggregate_document")
+        result = aggregate_tool.invoke(
+            {
+                "runtime": ToolRuntime(state=state, context=None, tool_call_id="agg", store=None, stream_writer=lambda _: None, config={}),
+                "sections": [
+                    {"section_number": 2, "file": "/section_2.md", "title": "Results & Discussion"},
+                    {"section_number": 1, "file": "/section_1.md", "title": "Introduction"},
+                ],
+                "output_file": "/final.md",
+            }
+        )
+        final_content = "\n".join(result.update["files"]["/final.md"]["content"])
+        assert final_content == (
+            "# Table of Contents\n"
+            "1. [Introduction](#introduction)\n"
+            "2. [Results & Discussion](#results-discussion)\n"
+            "\n"
+            "## Introduction\n\nFirst line\n\n  indented\n\n"
+            "## Results & Discussion\n\nSecond body\n\n"
+        )
+
+    def test_aggregate_document_names_missing_section(self):
+        """Test that aggregate_document reports which section file could not be read."""
+        state = FilesystemState(
+            messages=[],
+            files={"/section_1.md": FileData(content=["First"], created_at="2021-01-01", modified_at="2021-01-01")},
+        )
+        middleware = FilesystemMiddleware()
+        aggregate_tool = next(tool for tool in middleware.tools if tool.name == "aggregate_document")
+        with pytest.raises(ValueError, match="/section_2.md") as exc_info:
+            aggregate_tool.invoke(
+                {
+                    "runtime": ToolRuntime(state=state, context=None, tool_call_id="agg", store=None, stream_writer=lambda _: None, config={}),
+                    "sections": [
+                        {"section_number": 1, "file": "/section_1.md"},
+                        {"section_number": 2, "file": "/section_2.md"},
+                    ],
+                    "output_file": "/final.md",
+                }
+            )
+        assert "/section_1.md" not in str(exc_info.value)
+
+    def test_aggregate_document_reports_filesystem_read_error(self, tmp_path):
+        """Test that a FilesystemBackend read error is raised instead of pasted into the document."""
+        from deepagents.backends import FilesystemBackend
+
+        (tmp_path / "section_1.md").write_bytes(b"\xff\xfe not utf-8")
+        middleware = FilesystemMiddleware(backend=FilesystemBackend(root_dir=tmp_path, virtual_mode=True))
+        aggregate_tool = next(tool for tool in middleware.tools if tool.name == "aggregate_document")
+        with pytest.raises(ValueError, match="Error reading file"):
+            aggregate_tool.invoke(
+                {
+                    "runtime": ToolRuntime(state=FilesystemState(messages=[], files={}), context=None, tool_call_id="agg", store=None, stream_writer=lambda _: None, config={}),
+                    "sections": [{"section_number": 1, "file": "/section_1.md"}],
+                    "output_file": "/final.md",
+                }
+            )
+
     def test_intercept_short_toolmessage(self):
         """Test that small ToolMessages pass through unchanged."""
         middleware = FilesystemMiddleware(tool_token_limit_before_evict=1000)
@@ -920,6 +1033,158 @@ class TestFilesystemMiddleware:
         assert "/large_tool_results/test_call_id" in result.update["files"]
 
 
+class TestSubAgentMiddleware:
+    @staticmethod
+    def _runtime(tool_call_id="parent_call"):
+        return ToolRuntime(
+            state={"messages": [], "files": {}},
+            context=None,
+            tool_call_id=tool_call_id,
+            store=None,
+            stream_writer=lambda _: None,
+            config={},
+        )
+
+    @staticmethod
+    def _task_tool(replies, **spec):
+        from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+
+        subagent = create_agent(GenericFakeChatModel(messages=iter(replies)), tools=[])
+        middleware = SubAgentMiddleware(
+            default_model="claude-sonnet-4-20250514",
+            subagents=[{"name": "researcher", "description": "Researches things", "runnable": subagent, **spec}],
+            general_purpose_agent=False,
+        )
+        return middleware.tools[0]
+
+    def test_cacheable_subagent_reuses_result(self):
+        # Only one reply is available, so a second real run would fail
+        task_tool = self._task_tool([AIMessage(content="final answer")], cacheable=True)
+
+        first = task_tool.func(description="look  it up", subagent_type="researcher", runtime=self._runtime("call_1"))
+        second = task_tool.func(description="look it up", subagent_type="researcher", runtime=self._runtime("call_2"))
+
+        assert first.update["messages"][0].content == "final answer"
+        assert second.update["messages"][0].content == "final answer"
+        assert second.update["messages"][0].tool_call_id == "call_2"
+
+    def test_cache_hit_does_not_replay_file_writes(self):
+        from langgraph.graph import START, StateGraph
+
+        runs = []
+
+        def write_notes(state):
+            runs.append(1)
+            return {"messages": [AIMessage(content="wrote notes", id="w1")], "files": {"/notes.md": create_file_data("v1")}}
+
+        graph = StateGraph(FilesystemState)
+        graph.add_node("write_notes", write_notes)
+        graph.add_edge(START, "write_notes")
+        task_tool = SubAgentMiddleware(
+            default_model="claude-sonnet-4-20250514",
+            subagents=[{"name": "researcher", "description": "Researches things", "runnable": graph.compile(), "cacheable": True}],
+            general_purpose_agent=False,
+        ).tools[0]
+
+        first = task_tool.func(description="take notes", subagent_type="researcher", runtime=self._runtime("call_1"))
+        assert first.update["files"]["/notes.md"]["content"] == ["v1"]
+
+        # The parent has since rewritten the file. The cache key ignores parent state, so this
+        # still hits, but it must not restore the old version
+        runtime = self._runtime("call_2")
+        runtime.state["files"] = {"/notes.md": create_file_data("v2")}
+        second = task_tool.func(description="take notes", subagent_type="researcher", runtime=runtime)
+
+        assert len(runs) == 1
+        assert "files" not in second.update
+        assert second.update["messages"][0].content == "wrote notes"
+        assert second.update["messages"][0].tool_call_id == "call_2"
+
+    def test_task_tool_runs_subagents_natively_async(self):
+        import asyncio
+
+        task_tool = self._task_tool([AIMessage(content="first"), AIMessage(content="second")])
+        assert task_tool.coroutine is not None
+
+        async def run_both():
+            return await asyncio.gather(
+                task_tool.coroutine(description="one", subagent_type="researcher", runtime=self._runtime("call_1")),
+                task_tool.coroutine(description="two", subagent_type="researcher", runtime=self._runtime("call_2")),
+            )
+
+        results = asyncio.run(run_both())
+        assert sorted(result.update["messages"][0].content for result in results) == ["first", "second"]
+        assert [result.update["messages"][0].tool_call_id for result in results] == ["call_1", "call_2"]
+
+    def test_sync_task_calls_respect_concurrency_cap(self):
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        class SlowFakeChatModel(GenericFakeChatModel):
+            def _generate(self, *args, **kwargs):
+                with lock:
+                    running.append(1)
+                    peak.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.pop()
+                return super()._generate(*args, **kwargs)
+
+        subagent = create_agent(SlowFakeChatModel(messages=iter([AIMessage(content="a"), AIMessage(content="b")])), tools=[])
+        task_tool = SubAgentMiddleware(
+            default_model="claude-sonnet-4-20250514",
+            subagents=[{"name": "researcher", "description": "Researches things", "runnable": subagent}],
+            general_purpose_agent=False,
+            max_concurrent_subagents=1,
+        ).tools[0]
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [
+                pool.submit(task_tool.func, description=description, subagent_type="researcher", runtime=self._runtime(call_id))
+                for description, call_id in (("one", "call_1"), ("two", "call_2"))
+            ]
+            results = [future.result() for future in futures]
+
+        assert max(peak) == 1
+        assert sorted(result.update["messages"][0].content for result in results) == ["a", "b"]
+
+    def test_streamed_updates_only_carry_own_tool_calls_entry(self):
+        import asyncio
+
+        task_tool = self._task_tool([AIMessage(content="done")])
+        writes = []
+        earlier_entry = {"tool_calls": [{"id": "t0", "name": "ls", "args": {}, "status": "completed"}], "subagent_type": "researcher"}
+        runtime = ToolRuntime(
+            state={"messages": [], "files": {}, "subagent_tool_calls_map": {"earlier_call": earlier_entry}},
+            context=None,
+            tool_call_id="call_1",
+            store=None,
+            stream_writer=writes.append,
+            config={},
+        )
+
+        asyncio.run(task_tool.coroutine(description="one", subagent_type="researcher", runtime=runtime))
+
+        assert writes
+        assert all(list(write["subagent_tool_calls_map"]) == ["call_1"] for write in writes)
+
+    def test_subagent_results_not_cached_by_default(self):
+        task_tool = self._task_tool([AIMessage(content="first"), AIMessage(content="second")])
+
+        first = task_tool.func(description="look it up", subagent_type="researcher", runtime=self._runtime("call_1"))
+        second = task_tool.func(description="look it up", subagent_type="researcher", runtime=self._runtime("call_2"))
+
+        assert first.update["messages"][0].content == "first"
+        assert second.update["messages"][0].content == "second"
+
+
 class TestPatchToolCallsMiddleware:
     def test_first_message(self) -> None:
         input_messages = [
@@ -1,5 +1,6 @@
 """JSON validation tool for verifying JSON syntax and structure."""
 
+import io
 import json
 from typing import Dict, Any, Optional
 from langchain_core.tools import tool
@@ -35,7 +36,7 @@ def validate_json(json_string: Optional[str] = None, file_path: Optional[str] =
         # Validate a JSON string directly
         validate_json(json_string='{"sections": [{"id": "section_1"}]}')
     """
-    result_parts = []
+    buf = io.StringIO()
     json_content = ""
     
     # Determine the source of JSON content
@@ -44,22 +45,22 @@ def validate_json(json_string: Optional[str] = None, file_path: Optional[str] =
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 json_content = f.read()
-            result_parts.append(f"📄 Reading JSON from file: {file_path}")
-            result_parts.append("")
+            buf.write(f"📄 Reading JSON from file: {file_path}\n")
+            buf.write("\n")
         except FileNotFoundError:
             return f"❌ ERROR: File not found: {file_path}"
-        except Exception as e:
+        except (OSError, ValueError) as e:
             return f"❌ ERROR: Could not read file {file_path}: {str(e)}"
     elif json_string:
         # Use provided JSON string
         json_content = json_string
-        result_parts.append("📄 Validating provided JSON string")
-        result_parts.append("")
+        buf.write("📄 Validating provided JSON string\n")
+        buf.write("\n")
     else:
         return "❌ ERROR: Either 'json_string' or 'file_path' must be provided."
     
     # Validate the JSON content
-    if not json_content or not json_content.strip():
+    if not json_content or json_content.isspace():
         return "❌ ERROR: JSON content is empty or contains only whitespace. Please provide valid JSON."
     
     try:
@@ -120,43 +121,40 @@ def validate_json(json_string: Optional[str] = None, file_path: Optional[str] =
             validation_checks.append("✓ Valid JSON (primitive value)")
         
         # Success message
-        result_parts.append("✅ JSON is VALID")
-        result_parts.append("")
-        result_parts.append("Validation details:")
-        result_parts.extend(validation_checks)
+        buf.write("✅ JSON is VALID\n")
+        buf.write("\n")
+        buf.write("Validation details:\n")
+        buf.writelines(f"{check}\n" for check in validation_checks)
         
-        return "\n".join(result_parts)
+        return buf.getvalue().rstrip("\n")
         
     except json.JSONDecodeError as e:
         # Detailed error information
         error_msg = f"❌ JSON is INVALID"
-        result_parts.append(error_msg)
-        result_parts.append("")
-        result_parts.append(f"Error: {e.msg}")
-        result_parts.append(f"Location: Line {e.lineno}, Column {e.colno}")
+        buf.write(f"{error_msg}\n")
+        buf.write("\n")
+        buf.write(f"Error: {e.msg}\n")
+        buf.write(f"Location: Line {e.lineno}, Column {e.colno}\n")
         
         # Show the problematic line if possible
         if e.lineno and json_content:
             lines = json_content.split('\n')
             if e.lineno <= len(lines):
                 problem_line = lines[e.lineno - 1]
-                result_parts.append(f"Problem line: {problem_line}")
+                buf.write(f"Problem line: {problem_line}\n")
                 # Show pointer to the column
                 if e.colno:
                     pointer = " " * (e.colno - 1) + "^"
-                    result_parts.append(f"            {pointer}")
+                    buf.write(f"            {pointer}\n")
         
-        result_parts.append("")
-        result_parts.append("Common JSON errors to check:")
-        result_parts.append("  - Missing or extra commas")
-        result_parts.append("  - Unclosed braces {} or brackets []")
-        result_parts.append("  - Unescaped quotes in strings")
-        result_parts.append("  - Trailing commas (not allowed in JSON)")
-        result_parts.append("  - Single quotes instead of double quotes")
-        result_parts.append("  - Unquoted property names")
+        buf.write("\n")
+        buf.write("Common JSON errors to check:\n")
+        buf.write("  - Missing or extra commas\n")
+        buf.write("  - Unclosed braces {} or brackets []\n")
+        buf.write("  - Unescaped quotes in strings\n")
+        buf.write("  - Trailing commas (not allowed in JSON)\n")
+        buf.write("  - Single quotes instead of double quotes\n")
+        buf.write("  - Unquoted property names\n")
         
-        return "\n".join(result_parts)
-    
-    except Exception as e:
-        return f"❌ Unexpected error during validation: {str(e)}"
+        return buf.getvalue().rstrip("\n")
 